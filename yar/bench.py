@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+"""Benchmarks for checksum and file ingestion hot paths."""
+
+from array import array
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import zipfile
+
+import yar.cksum as cksum
+import yar.io as io
+
+SIZES = (2**11, 2**13, 2**15, 2**17, 2**19, 2**20)
+
+
+def checksum_str(data, _):
+    return lambda: cksum.checksum(data)
+
+
+def checksum_array(data, _):
+    buf = array("B", data)
+    return lambda: cksum.checksum(buf)
+
+
+def checksum_ints(data, _):
+    ints = list(bytearray(data))
+    return lambda: cksum.checksum(ints)
+
+
+def digest_all(data, _):
+    return lambda: cksum.MultiDigest(("sum", "crc32", "sha1"),
+                                     data).hexdigests()
+
+
+def file_to_bytes(data, dir_):
+    path = os.path.join(dir_, "image.bin")
+    with open(path, "wb") as fd:
+        fd.write(data)
+
+    def run():
+        with open(path, "rb") as fd:
+            io.file_to_bytes(fd)
+    return run
+
+
+def load_buffer(data, dir_):
+    path = os.path.join(dir_, "image.bin")
+    with open(path, "wb") as fd:
+        fd.write(data)
+
+    def run():
+        with open(path, "rb") as fd, io.load_buffer(fd) as buf:
+            cksum.checksum(buf)
+    return run
+
+
+def zip_member(data, dir_):
+    path = os.path.join(dir_, "image.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zfd:
+        zfd.writestr("image.bin", data)
+
+    def run():
+        for fds in io.gen_fds([path]):
+            for (_, fd) in fds:
+                io.file_to_bytes(fd)
+    return run
+
+
+def zip_entry(data, dir_):
+    path = os.path.join(dir_, "image.zip")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zfd:
+        zfd.writestr("image.bin", data)
+
+    def run():
+        for entry in io.gen_entries([path]):
+            entry.read()
+    return run
+
+
+# Each benchmark is called with (data, scratch dir), and returns a
+# function which processes data once.
+SUITES = {"checksum": (("checksum-str", checksum_str),
+                       ("checksum-array", checksum_array),
+                       ("checksum-ints", checksum_ints),
+                       ("digest-sum-crc32-sha1", digest_all)),
+          "io": (("file_to_bytes", file_to_bytes),
+                 ("load_buffer+checksum", load_buffer),
+                 ("gen_zip_fds", zip_member),
+                 ("zip-entry-read", zip_entry))}
+
+
+def measure(fn, min_time=0.25, min_runs=3):
+    """Return the best time of fn, over at least min_time seconds."""
+    (best, runs, start) = (None, 0, time.time())
+    while runs < min_runs or time.time() - start < min_time:
+        t = time.time()
+        fn()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+        runs += 1
+    return best
+
+
+def run(suites, sizes=SIZES, min_time=0.25):
+    """Run suites, returning a list of result dicts."""
+    results = []
+    dir_ = tempfile.mkdtemp(prefix="yar-bench")
+    try:
+        for size in sizes:
+            data = os.urandom(size)
+            for suite in suites:
+                for (name, bench) in SUITES[suite]:
+                    secs = measure(bench(data, dir_), min_time)
+                    results.append(
+                        {"suite": suite, "path": name, "bytes": size,
+                         "seconds": secs,
+                         "mb_s": size / max(secs, 1e-9) / 2**20})
+    finally:
+        shutil.rmtree(dir_)
+    return results
+
+
+def save(results, path):
+    """Save results to path as JSON, with details of the environment."""
+    with open(path, "w") as fd:
+        json.dump({"time": time.time(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "numpy": cksum.numpy is not None,
+                   "results": results}, fd, indent=2, sort_keys=True)
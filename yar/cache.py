@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+"""Persistent digest cache.
+
+   Digests are keyed by the (path, ident, size) key of an entry from
+   yar.io. For plain files, ident is the modification time; for ZIP
+   members, it's the CRC32 from the central directory, so the member
+   doesn't have to be decompressed to find out whether it's changed.
+   For tar members, it's the archive's modification time and the
+   member's name."""
+
+from contextlib import closing
+import os
+import sqlite3
+import zipfile
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS digests (
+    path TEXT NOT NULL,
+    ident TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    algo TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (path, ident, size, algo))"""
+
+
+def default_path():
+    """Return the default location of the cache."""
+    base = (os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "yar", "digests.sqlite")
+
+
+def current_keys(path):
+    """Return the set of (ident, size) pairs currently valid for path."""
+    if not os.path.exists(path):
+        return set()
+
+    st = os.stat(path)
+    keys = set([("m%r" % st.st_mtime, st.st_size)])
+    if zipfile.is_zipfile(path):
+        with closing(zipfile.ZipFile(path)) as zfd:
+            keys.update(("c%08x" % info.CRC, info.file_size)
+                        for info in zfd.infolist())
+    return keys
+
+
+def is_current(ident, size, keys):
+    """Is (ident, size) still valid, given the current_keys() of its path?
+
+       Tar members are valid as long as their archive is unchanged."""
+    if (ident, size) in keys:
+        return True
+    (archive_ident, _, member) = ident.partition(":")
+    return bool(member) and any(archive_ident == key for (key, _) in keys)
+
+
+class Cache():
+
+    """A cache of digests, stored in SQLite."""
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        dir_ = os.path.dirname(self.path)
+        if dir_ and not os.path.isdir(dir_):
+            os.makedirs(dir_)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(SCHEMA)
+
+    def lookup(self, entry, algos):
+        """Return a dict of algo -> digest for entry.
+
+           Returns None unless all the algos are cached."""
+        (path, ident, size) = entry.key()
+        rows = self.db.execute(
+            "SELECT algo, value FROM digests "
+            "WHERE path = ? AND ident = ? AND size = ?",
+            (path, ident, size))
+        found = dict(rows)
+        if not all(algo in found for algo in algos):
+            return None
+        return dict((algo, found[algo]) for algo in algos)
+
+    def store(self, entry, digests):
+        """Store a dict of algo -> digest for entry."""
+        (path, ident, size) = entry.key()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+            [(path, ident, size, algo, value)
+             for (algo, value) in digests.iteritems()])
+
+    def stats(self):
+        """Return a dict of statistics about the cache."""
+        (digests, entries, paths) = self.db.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT path || ident || size), "
+            "COUNT(DISTINCT path) FROM digests").fetchone()
+        return {"path": self.path,
+                "digests": digests,
+                "entries": entries,
+                "paths": paths,
+                "bytes": os.path.getsize(self.path)}
+
+    def prune(self):
+        """Remove digests of files which have changed or gone away.
+
+           Returns the number of digests removed."""
+        removed = 0
+        paths = [path for (path,) in
+                 self.db.execute("SELECT DISTINCT path FROM digests")]
+        for path in paths:
+            keys = current_keys(path)
+            stale = [(ident, size) for (ident, size) in self.db.execute(
+                "SELECT DISTINCT ident, size FROM digests WHERE path = ?",
+                (path,)) if not is_current(ident, size, keys)]
+            for (ident, size) in stale:
+                removed += self.db.execute(
+                    "DELETE FROM digests "
+                    "WHERE path = ? AND ident = ? AND size = ?",
+                    (path, ident, size)).rowcount
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return removed
+
+    def clear(self):
+        """Remove all digests."""
+        self.db.execute("DELETE FROM digests")
+        self.db.commit()
+        self.db.execute("VACUUM")
+
+    def close(self):
+        """Write pending changes and close the cache."""
+        self.db.commit()
+        self.db.close()
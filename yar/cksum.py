@@ -6,6 +6,287 @@
 
 """Checksumming utilities."""
 
+from array import array
+import hashlib
+import mmap
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ["checksum", "Checksum", "SplitChecksum", "CRC32", "MultiDigest",
+           "PrefixSums"]
+
+# Objects which are summed as raw bytes, rather than as sequences of
+# integers.
+BUFFER_TYPES = (str, bytearray, memoryview, buffer, mmap.mmap)
+
+CHUNK_SIZE = 2**16              # Bytes summed per pass without NumPy
+
+# Maps each byte to its low nibble, for bytearray.translate()
+LOW_NIBBLES = "".join(chr(b & 0x0F) for b in xrange(256))
+
+
+def is_buffer(obj):
+    """Is obj a buffer of unsigned bytes?"""
+    return (isinstance(obj, BUFFER_TYPES) or
+            (isinstance(obj, array) and obj.typecode == "B"))
+
+
+def buffer_sum(buf):
+    """Return the sum of the unsigned bytes in buf."""
+    if len(buf) == 0:
+        return 0
+
+    if numpy is not None:
+        return int(numpy.frombuffer(buf, dtype=numpy.uint8).sum(
+            dtype=numpy.uint64))
+
+    if isinstance(buf, (array, bytearray)):
+        return sum(buf)
+
+    return sum(sum(bytearray(buf[off:off + CHUNK_SIZE]))
+               for off in xrange(0, len(buf), CHUNK_SIZE))
+
+
 def checksum(bytes):
-    """Return the simple checksum of a sequence of bytes."""
+    """Return the simple checksum of a sequence of bytes.
+
+       Buffers (str, bytearray, array('B'), mmap, memoryview) are
+       summed in bulk; other sequences are treated as integers."""
+    if is_buffer(bytes):
+        return buffer_sum(bytes)
     return reduce(lambda a, b: a + b % 2**16, bytes)
+
+
+class Checksum():
+
+    """Incremental checksum, in the style of hashlib.
+
+       Data is fed in with update() as it arrives. value holds the
+       full-width sum; digest() and hexdigest() return the 16-bit sum
+       which the programmer reports."""
+
+    name = "sum"
+    digest_size = 2
+
+    def __init__(self, data=None):
+        self.value = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """Add data to the checksum."""
+        if is_buffer(data):
+            self.value += buffer_sum(data)
+        else:
+            self.value = reduce(lambda a, b: a + b % 2**16, data, self.value)
+
+    def copy(self):
+        """Return a copy of this checksum."""
+        c = Checksum()
+        c.value = self.value
+        return c
+
+    def programmer_sum(self):
+        """Return the 16-bit sum, as the programmer calculates it."""
+        return self.value & 0xFFFF
+
+    def digest(self):
+        return struct.pack(">H", self.programmer_sum())
+
+    def hexdigest(self):
+        return "%04x" % self.programmer_sum()
+
+
+class SplitChecksum():
+
+    """Checksums of the ways the programmer can split a buffer.
+
+       In one pass, this sums each of the four byte lanes (every fourth
+       byte), and the low nibbles of all bytes. From those, it can
+       report the checksums of even/odd bytes for 16-bit sets, of each
+       lane for 32-bit sets, and of the low and high nibbles."""
+
+    def __init__(self, data=None):
+        self._lanes = [0, 0, 0, 0]
+        self._low = 0
+        self._offset = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """Add data to the checksums."""
+        for off in xrange(0, len(data), CHUNK_SIZE):
+            chunk = bytearray(data[off:off + CHUNK_SIZE])
+            for lane in xrange(4):
+                self._lanes[(self._offset + lane) % 4] += sum(chunk[lane::4])
+            self._low += sum(chunk.translate(LOW_NIBBLES))
+            self._offset = (self._offset + len(chunk)) % 4
+
+    def copy(self):
+        """Return a copy of these checksums."""
+        c = SplitChecksum()
+        c._lanes = list(self._lanes)
+        (c._low, c._offset) = (self._low, self._offset)
+        return c
+
+    def total(self):
+        """Return the checksum of the whole buffer."""
+        return sum(self._lanes)
+
+    def lanes(self, ways):
+        """Return a list of the checksums of a ways-way split.
+
+           The first checksum is of the lane starting at the first
+           byte."""
+        if ways not in (1, 2, 4):
+            raise ValueError("Can't split %d ways" % ways)
+        return [sum(self._lanes[lane::ways]) for lane in xrange(ways)]
+
+    def nibbles(self):
+        """Return a tuple of the checksums of the (low, high) nibbles."""
+        return (self._low, (self.total() - self._low) >> 4)
+
+
+class CRC32():
+
+    """CRC32, with the same interface as Checksum."""
+
+    name = "crc32"
+    digest_size = 4
+
+    def __init__(self, data=None):
+        self.value = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """Add data to the CRC."""
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, str):
+            data = buffer(data)
+        self.value = zlib.crc32(data, self.value) & 0xFFFFFFFF
+
+    def copy(self):
+        """Return a copy of this CRC."""
+        c = CRC32()
+        c.value = self.value
+        return c
+
+    def digest(self):
+        return struct.pack(">I", self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+# Split checksums MultiDigest can compute, by name.
+SPLITS = {"split16": lambda sp: sp.lanes(2),
+          "split32": lambda sp: sp.lanes(4),
+          "nibble": lambda sp: sp.nibbles()}
+
+
+def new(name, data=None):
+    """Return a new hasher for the named digest.
+
+       The name may be "sum", "crc32", or any algorithm hashlib
+       supports."""
+    if name == "sum":
+        return Checksum(data)
+    elif name == "crc32":
+        return CRC32(data)
+    h = hashlib.new(name)
+    if data is not None:
+        h.update(data)
+    return h
+
+
+class MultiDigest():
+
+    """Several digests of the same data, computed in one pass.
+
+       Names are anything new() accepts, or the name of a split in
+       SPLITS. Split checksums share a single SplitChecksum."""
+
+    def __init__(self, names, data=None):
+        self.names = tuple(names)
+        self._split = None
+        self._hashers = {}
+        for name in self.names:
+            if name in SPLITS:
+                self._split = self._split or SplitChecksum()
+            else:
+                self._hashers[name] = new(name)
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """Add data to all digests."""
+        for h in self._hashers.itervalues():
+            h.update(data)
+        if self._split:
+            self._split.update(data)
+
+    def hexdigests(self):
+        """Return a dict of name -> hex digest.
+
+           Checksums are full-width, as checksum_cmd has always shown
+           them, and the parts of split checksums are space-separated."""
+        digests = {}
+        for name in self.names:
+            if name in SPLITS:
+                digests[name] = " ".join(
+                    "%06x" % v for v in SPLITS[name](self._split))
+            elif name == "sum":
+                digests[name] = "%06x" % self._hashers[name].value
+            else:
+                digests[name] = self._hashers[name].hexdigest()
+        return digests
+
+
+class PrefixSums():
+
+    """Cumulative sums of a buffer.
+
+       Once built, the checksum of any range of the buffer takes
+       constant time."""
+
+    def __init__(self, data):
+        if numpy is not None:
+            self._sums = numpy.zeros(len(data) + 1, dtype=numpy.uint64)
+            if len(data):
+                numpy.cumsum(numpy.frombuffer(data, dtype=numpy.uint8),
+                             dtype=numpy.uint64, out=self._sums[1:])
+            return
+
+        self._sums = array("L", [0])
+        total = 0
+        for off in xrange(0, len(data), CHUNK_SIZE):
+            for b in bytearray(data[off:off + CHUNK_SIZE]):
+                total += b
+                self._sums.append(total)
+
+    def __len__(self):
+        """Return the length of the buffer."""
+        return len(self._sums) - 1
+
+    def range_sum(self, start, end):
+        """Return the checksum of bytes [start, end) of the buffer."""
+        if not 0 <= start <= end <= len(self):
+            raise ValueError("Range %x:%x is outside of %d bytes" % (
+                start, end, len(self)))
+        return int(self._sums[end] - self._sums[start])
+
+    def banks(self, size):
+        """Return a list of (start, end, checksum) for each bank of size.
+
+           The last bank is short if the buffer isn't a multiple of
+           size."""
+        return [(start, min(start + size, len(self)),
+                 self.range_sum(start, min(start + size, len(self))))
+                for start in xrange(0, len(self), size)]
@@ -6,21 +6,27 @@
 
 """Yar CLI."""
 
-from itertools import chain
+from collections import deque
+from functools import partial
 from optparse import OptionParser, OptionGroup
-from os.path import basename
+from os.path import abspath, basename
 import format
 import logging
+import multiprocessing
 import re
 import sys
+import tempfile
 
 import serial
 from serial.tools import list_ports
 
-from control import Yar
+from control import Yar, differing_blocks
 import yar.devices.matcher as matcher
 import yar.pak as pak
+import yar.bench as bench
+import yar.cache as cache
 import yar.cksum as cksum
+import yar.index as index
 import yar.io as io
 
 
@@ -48,6 +54,12 @@ def expand_command(cmd, cmds):
     return None
 
 
+# Checksum splits, and the names of their digests
+SPLITS = {"16": "split16",
+          "32": "split32",
+          "nibble": "nibble"}
+
+
 def default_dev():
     """Return the default device."""
     p = tuple(list_ports.grep("serial"))
@@ -88,6 +100,44 @@ def get_parser():
                   action="store_true")
     p.add_option_group(dg)
 
+    kg = OptionGroup(p, "Checksum options")
+    kg.add_option("--cache", default=False, action="store_true",
+                  help="Cache checksums of unchanged files between runs")
+    kg.add_option("--cache-file",
+                  help="Checksum cache location. Default: " +
+                  cache.default_path())
+    kg.add_option("--recursive", "-r", default=False, action="store_true",
+                  help="Checksum the files in directories, recursively")
+    kg.add_option("--include", action="append", default=[],
+                  help="With --recursive, only checksum files matching "
+                  "PATTERN. May be given more than once")
+    kg.add_option("--exclude", action="append", default=[],
+                  help="With --recursive, skip files and directories "
+                  "matching PATTERN. May be given more than once")
+    kg.add_option("--depth", default=0, type="int",
+                  help="Open archives nested up to N deep inside archives. "
+                  "Default: 0")
+    kg.add_option("--jobs", "-j", default=1, type="int",
+                  help="Checksum files in N processes. Default: 1")
+    kg.add_option("--digest", default="sum",
+                  help="Comma-separated digests to show: sum, crc32, md5, "
+                  "sha1, or any other hashlib algorithm. Default: sum")
+    kg.add_option("--split", type="choice", choices=sorted(SPLITS),
+                  help="Also show checksums of the even/odd bytes (16), "
+                  "of each byte of 32-bit words (32), or of the low/high "
+                  "nibbles (nibble)")
+    kg.add_option("--range", action="append", default=[],
+                  help="Checksum bytes START:END of each file, END "
+                  "exclusive. May be given more than once")
+    kg.add_option("--banks", type="int",
+                  help="Checksum each SIZE-byte bank of each file")
+    p.add_option_group(kg)
+
+    ig = OptionGroup(p, "Index options")
+    ig.add_option("--index",
+                  help="ROM index location. Default: " + index.default_path())
+    p.add_option_group(ig)
+
     return p
 
 
@@ -101,14 +151,201 @@ def await_operator(yar, msg):
     return r
 
 
+def cached_digests(entry, algos, cache=None):
+    """Return a dict of algo -> hex digest, using cache if possible."""
+    digests = cache and cache.lookup(entry, algos)
+    if digests:
+        return digests
+    digests = io.digest_entry(entry, algos)
+    if cache:
+        cache.store(entry, digests)
+    return digests
+
+
+def gen_digests(entries, algos, cache=None, jobs=1):
+    """Return a generator of (entry, {algo: hex digest}) tuples.
+
+       With jobs > 1, entries which aren't cached are digested in a
+       pool of processes, a few per process ahead of the results being
+       consumed, so output streams and memory use doesn't grow with the
+       number of entries. Results are always in the order of entries."""
+    if jobs <= 1:
+        for entry in entries:
+            yield (entry, cached_digests(entry, algos, cache))
+        return
+
+    digest = partial(io.digest_entry, names=algos)
+    pending = deque()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for entry in entries:
+            digests = cache and cache.lookup(entry, algos)
+            if not digests:
+                # Tar members go to the pool with their contents, rather
+                # than each worker decompressing the archive again
+                digests = pool.apply_async(
+                    digest, (io.detach(entry, keep=True),))
+            pending.append((entry, digests))
+            if len(pending) > jobs * 4:
+                yield finish_digests(pending.popleft(), cache)
+        while pending:
+            yield finish_digests(pending.popleft(), cache)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def finish_digests(pending, cache=None):
+    """Return (entry, digests) for a pending (entry, digests) tuple.
+
+       digests is a dict, or an AsyncResult, which is waited for and
+       its result cached."""
+    (entry, digests) = pending
+    if isinstance(digests, dict):
+        return (entry, digests)
+    digests = digests.get()
+    if cache:
+        cache.store(entry, digests)
+    return (entry, digests)
+
+
+def parse_range(spec):
+    """Return a (start, end) tuple for a START:END range."""
+    try:
+        (start, end) = spec.split(":")
+        return (int(start, 0), int(end, 0))
+    except ValueError:
+        raise ValueError("Invalid range `%s'" % spec)
+
+
+def range_checksums(entry, ranges=(), bank_size=None):
+    """Return a list of (start, end, checksum) for ranges of an entry."""
+    with entry.open() as fd, io.load_buffer(fd, entry.size) as data:
+        sums = cksum.PrefixSums(data)
+    return ([(start, end, sums.range_sum(start, end))
+             for (start, end) in ranges] +
+            (bank_size and sums.banks(bank_size) or []))
+
+
+def digest_algos(opts):
+    """Return the digest algorithms selected by opts.
+
+       Raises ValueError for a digest cksum.new() doesn't know, before
+       anything is read."""
+    algos = [algo.strip() for algo in opts.digest.split(",")]
+    for algo in algos:
+        try:
+            cksum.new(algo)
+        except ValueError:
+            raise ValueError("Unknown digest `%s'" % algo)
+    if opts.split:
+        algos.append(SPLITS[opts.split])
+    return algos
+
+
+def read_image(path):
+    """Return the base address and a file of the binary image in path.
+
+       Text formats, like Intel HEX, are decoded into a temporary
+       file, by the format of the extension of path. The image starts
+       at the lowest address of any record, as with objcopy, so one
+       based high in memory isn't padded out from 0. Binary images are
+       based at 0."""
+    fmt = format.by_path(path)
+    inp = open(path, "rb")
+    if fmt == format.BINARY:
+        return (0, inp)
+
+    with inp:
+        decoder = format.CODECS[fmt][1]()
+        base = min([addr for (addr, _) in decoder.gen_records(inp)] or [0])
+        inp.seek(0)
+        decoder.reset()
+        out = tempfile.TemporaryFile()
+        decoder.decode_into(inp, out, base)
+    out.seek(0)
+    return (base, out)
+
+
+def load_image(path):
+    """Return a file of the binary image in path, as read_image()."""
+    return read_image(path)[1]
+
+
+def gen_inputs(opts, args):
+    """Return the inputs named by args.
+
+       With --recursive, directories are walked for files."""
+    if opts.recursive:
+        return io.walk(args, opts.include, opts.exclude)
+    return args
+
+
  # Commands
 
 
-def checksum_cmd(_, *args):
+def bench_cmd(s, suite="all", output=None):
+    """Benchmark checksum (checksum), file reading (io), or all"""
+    suites = suite == "all" and sorted(bench.SUITES) or [suite]
+    if not set(suites) <= set(bench.SUITES):
+        print "Unknown benchmark suite `%s'" % suite
+        return 1
+
+    results = bench.run(suites)
+    for r in results:
+        print "%-24s %8d bytes %10.2f MB/s" % (r["path"], r["bytes"],
+                                               r["mb_s"])
+    if output:
+        bench.save(results, output)
+    return 0
+
+
+def cache_cmd(s, action="stats"):
+    """Show stats for (stats), prune, or clear the checksum cache"""
+    c = s.cache()
+    if action == "stats":
+        st = c.stats()
+        print "%s: %d checksums of %d files in %d paths, %d bytes" % (
+            st["path"], st["digests"], st["entries"], st["paths"],
+            st["bytes"])
+    elif action == "prune":
+        print "Pruned %d checksums" % c.prune()
+    elif action == "clear":
+        c.clear()
+    else:
+        print "Unknown cache action `%s'" % action
+        return 1
+    return 0
+
+
+def checksum_cmd(s, *args):
     """Checksum files"""
-    for (inpf, fd) in chain.from_iterable(io.gen_fds(args)):
-        print "%s %06x" % (
-            basename(inpf), cksum.checksum(io.file_to_bytes(fd)))
+    if s.opts.range or s.opts.banks:
+        try:
+            ranges = map(parse_range, s.opts.range)
+            for entry in io.gen_entries(gen_inputs(s.opts, args),
+                                        depth=s.opts.depth):
+                for (start, end, sum) in range_checksums(entry, ranges,
+                                                         s.opts.banks):
+                    print "%s %06x-%06x %06x" % (basename(entry.name),
+                                                 start, end - 1, sum)
+        except ValueError, e:
+            print e
+            return 1
+        return 0
+
+    try:
+        algos = digest_algos(s.opts)
+    except ValueError, e:
+        print e
+        return 1
+
+    c = s.opts.cache and s.cache() or None
+    entries = io.gen_entries(gen_inputs(s.opts, args), depth=s.opts.depth)
+    for (entry, digests) in gen_digests(entries, algos, c, s.opts.jobs):
+        print "%s %s" % (basename(entry.name),
+                         " ".join(digests[algo] for algo in algos))
     return 0
 
 
@@ -119,6 +356,50 @@ def checksum_ram_cmd(s):
     return 0
 
 
+def convert_cmd(s, input, output):
+    """Convert an image between binary, Intel HEX, S-records and MOS"""
+    try:
+        (base, inp) = read_image(input)
+        with inp, io.load_buffer(inp) as data:
+            fmt = format.by_path(output)
+            if fmt != format.BINARY:
+                encoder = format.CODECS[fmt][0]()
+                encoder.encode_buffer(data, base)
+                data = encoder.finalize()
+
+            with open(output, "wb") as outp:
+                outp.write(data)
+    except ValueError, e:
+        print e
+        return 1
+    return 0
+
+
+def diff_ram_cmd(s, file_):
+    """Compare programmer RAM with a file"""
+    with open(file_, "rb") as inp, io.load_buffer(inp) as local:
+        yar = s.yar()
+        device = yar.get_device()
+        try:
+            blocks = differing_blocks(
+                cksum.PrefixSums(local),
+                lambda start, end: yar.checksum_range(start, end - start),
+                0, len(local))
+            for (start, end) in blocks:
+                remote = yar.read_range(start, end - start)
+                for (addr, l, r) in zip(xrange(start, end),
+                                        bytearray(local[start:end]), remote):
+                    if l != r:
+                        print "%06x %02x %02x" % (addr, l, r)
+        finally:
+            # The programmer can't report the range it had, so select
+            # the device again, which sets the block size back to all
+            # of it
+            yar.set_ram_address(0)
+            yar.set_device(*device)
+    return int(bool(blocks))
+
+
 def download_cmd(s, output):
     """Dump programmer RAM to file."""
     yar = s.yar()
@@ -152,6 +433,25 @@ def download_device_cmd(s, output):
     return 0
 
 
+def dupes_cmd(s, *args):
+    """Find identical files, in directories and archives"""
+    c = s.opts.cache and s.cache() or None
+    entries = io.gen_entries(io.walk(args, s.opts.include, s.opts.exclude),
+                             depth=s.opts.depth)
+    groups = {}
+    for (entry, digests) in gen_digests(io.same_size(entries),
+                                        ("sum", "sha1"), c, s.opts.jobs):
+        groups.setdefault((entry.size, digests["sum"], digests["sha1"]),
+                          []).append(entry.name)
+
+    for ((size, sum, sha1), names) in sorted(groups.iteritems()):
+        if len(names) > 1:
+            print "%d bytes, sum %s, sha1 %s" % (size, sum, sha1)
+            for name in names:
+                print "  " + name
+    return 0
+
+
 def read_cmd(s):
     """Load device contents into programmer RAM"""
     yar = s.yar()
@@ -166,10 +466,45 @@ def read_cmd(s):
 
 def upload_cmd(s, file_):
     """Load file contents into programmer RAM"""
-    yar = s.yar()
-    yar.clear_ram()
-    with open(file_, "rb") as inp:
-        yar.load_from(inp)
+    # Start reading while connecting to the programmer
+    with load_image(file_) as inp, io.Prefetcher(inp) as source:
+        yar = s.yar()
+        yar.clear_ram()
+        yar.load_from(source)
+
+
+def index_cmd(s, action="stats", *dirs):
+    """Add ROMs in dirs to the index (build), or show its size (stats)"""
+    idx = s.index()
+    if action == "build":
+        c = s.opts.cache and s.cache() or None
+        # Walk from absolute paths, so each ROM is indexed by the
+        # absolute path of its file or archive
+        entries = io.gen_entries(
+            io.walk([abspath(dir_) for dir_ in dirs], s.opts.include,
+                    s.opts.exclude),
+            depth=s.opts.depth)
+        for (entry, digests) in gen_digests(entries, index.DIGESTS, c,
+                                            s.opts.jobs):
+            idx.add(entry.name, entry.size, digests)
+    elif action != "stats":
+        print "Unknown index action `%s'" % action
+        return 1
+    print "%s: %d ROMs" % (idx.path, len(idx))
+    return 0
+
+
+def identify_cmd(s, *args):
+    """Identify files using the ROM index"""
+    idx = s.index()
+    found = True
+    for entry in io.gen_entries(gen_inputs(s.opts, args), depth=s.opts.depth):
+        matches = idx.identify(entry.size,
+                               io.digest_entry(entry, index.DIGESTS))
+        found = found and bool(matches)
+        print "%s %s" % (basename(entry.name), ", ".join(
+            "%s (%s)" % match for match in matches) or "unknown")
+    return int(not found)
 
 
 def lookup_cmd(s, device):
@@ -194,6 +529,8 @@ def ports_cmd(s):
 class GlobalState():
 
     _yar = None
+    _cache = None
+    _index = None
     opts = None
     args = None
 
@@ -213,6 +550,18 @@ class GlobalState():
         """Return the configured Pak."""
         return pak.load(self.opts.pak)
 
+    def cache(self):
+        """Return the checksum cache."""
+        if not self._cache:
+            self._cache = cache.Cache(self.opts.cache_file)
+        return self._cache
+
+    def index(self):
+        """Return the ROM index."""
+        if not self._index:
+            self._index = index.Index(self.opts.index)
+        return self._index
+
     def _construct(self):
         return Yar(self.opts.port)           # FIXME, use all settings
 
@@ -251,6 +600,8 @@ def main():
     """Yar main entry point"""
     p = get_parser()
     (opts, cmd_args) = p.parse_args()
+    if opts.banks is not None and opts.banks <= 0:
+        p.error("--banks must be a positive number of bytes")
     if not cmd_args:
         p.print_help()
         return -1
@@ -260,6 +611,7 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
 
     cmds = get_commands_map()
+    cmd = cmd.replace("-", "_")
     cmd_ = expand_command(cmd, cmds.keys())
     cmd = cmd_ or cmd
     if cmd not in cmds:
@@ -285,6 +637,11 @@ def main():
             print "No device `%s' found, and nothing similar" % device
             return 3
     finally:
+        if s._cache:
+            s._cache.close()
+        if s._index:
+            s._index.close()
+
         # Make sure we don't leave crap in the recv buffer
         if s.connected():
             yar = s.yar()
@@ -65,6 +65,35 @@ def errorp(err):
     return bool(err & 2**31)
 
 
+def differing_blocks(local, remote_sum, start, end, min_block=256):
+    """Return a list of (start, end) blocks where remote data differs.
+
+       local is a PrefixSums of the local data, and remote_sum(start,
+       end) returns the 16-bit checksum of the remote data in [start,
+       end). The range is bisected until blocks are min_block bytes or
+       less. When one half of a differing range matches, the other
+       half must differ, so it isn't checked.
+
+       Differences which cancel out in the checksum can't be found."""
+    def differs(start, end):
+        return local.range_sum(start, end) & 0xFFFF != remote_sum(start, end)
+
+    def bisect(start, end):
+        if end - start <= min_block:
+            return [(start, end)]
+        mid = (start + end) // 2
+        blocks = []
+        if differs(start, mid):
+            blocks += bisect(start, mid)
+            if not differs(mid, end):
+                return blocks
+        return blocks + bisect(mid, end)
+
+    if start == end or not differs(start, end):
+        return []
+    return bisect(start, end)
+
+
 class Yar():
 
     """Class for communicating with Data I/O devices."""
@@ -121,16 +150,19 @@ class Yar():
             raise ProgrammerError(err)
         return r
 
-    def _await(self, max=60, fd=None):
+    def _await(self, max=60, fd=None, progress=None):
         """Await a response for long-running operations.
            Does not read the response.
 
-           This will wait up to max seconds for a response.
+           This will wait up to max seconds for a response, notifying
+           the listeners of progress, if any, every second.
            Returns True if a response is waiting, False if timed out."""
         tries = 0
         while self.port.inWaiting() == 0 and tries < max:
             time.sleep(1)
             tries += 1
+            if progress:
+                progress.notify()
         if tries == max:
             raise IOError("Timed out after %ds" % max)
         return tries != max
@@ -180,6 +212,11 @@ class Yar():
         self._writeline("%04x;", size)
         return self._readok()
 
+    def set_ram_address(self, address):
+        """Set the RAM address transfers and checksums begin at."""
+        self._writeline("%04x<", address)
+        return self._readok()
+
     def set_record_size(self, size):
         self._writeline("%02xH", size)
         return self._readok()
@@ -221,6 +258,24 @@ class Yar():
         r = self._resp()
         return r and int(r, 16) or r
 
+    def _select_range(self, start, size):
+        """Select size bytes of programmer RAM from start, for the next
+           transfer or checksum."""
+        if not self.set_ram_address(start) or not self.set_block_size(size):
+            raise IOError("Programmer didn't accept range %x:%x" % (
+                start, start + size))
+
+    def checksum_range(self, start, size):
+        """Return the checksum of size bytes of programmer RAM from start."""
+        self._select_range(start, size)
+        self._writeline("S")
+        self._await()
+        r = self._resp()
+        if not isinstance(r, str):
+            raise IOError("No checksum of %x:%x from programmer" % (
+                start, start + size))
+        return int(r, 16)
+
     def flush(self):
         """Flush any data waiting in the read buffer."""
         if self.port.inWaiting() > 0:
@@ -232,21 +287,42 @@ class Yar():
         self._await()
         return self._readok()
 
-    def program_device(self):
-        """Write programmer RAM to device."""
-        self._writeline("P")
-        self._await(max=300)
+    def _long_operation(self, phase, command, listeners):
+        """Run a long operation, returning its result.
+
+           Listeners receive events for phase every second until the
+           programmer responds."""
+        p = io.Progress(None, phase, listeners)
+        p.start()
+        self._writeline(command)
+        self._await(max=300, progress=p)
+        p.complete()
         return self._readok()
 
-    def verify(self):
+    def program_device(self, listeners=()):
+        """Write programmer RAM to device."""
+        return self._long_operation("program", "P", listeners)
+
+    def verify(self, listeners=()):
         """Verify a device against programmer RAM."""
-        self._writeline("V")
-        self._await(max=300)
-        return self._readok()
+        return self._long_operation("verify", "V", listeners)
+
+    def dump_to(self, outp, progress_to=None, listeners=()):
+        """Dump programmer RAM to file-like object.
 
-    def dump_to(self, outp, progress_to=None):
-        """Dump programmer RAM to file-like object."""
-        out = progress_to or sys.stderr
+           Progress is drawn to progress_to, or stderr, and sent to
+           listeners."""
+        self._receive(progress_to or sys.stderr, listeners).tofile(outp)
+
+    def read_range(self, start, size):
+        """Return an array of size bytes of programmer RAM from start."""
+        self._select_range(start, size)
+        return self._receive()
+
+    def _receive(self, out=None, listeners=()):
+        """Receive programmer RAM, returning an array of bytes.
+
+           If out is set, progress is drawn to it."""
         self.set_format(format.BINARY)
         self._writeline("O")
         data_buf = array.array("B")
@@ -262,17 +338,19 @@ class Yar():
             raise IOError(msg % tuple(header.tolist()))
 
         sz = int("".join(map(str, header[0x0A:0x0F])), 16)
-        p = io.Progress(sz)
-        while len(data_buf) < sz:
-            # Don't overflow the buffer
-            tr = self.port.read(min(sz - len(data_buf), 128))
-            if tr != '':
-                data_buf.fromstring(tr)
-                p.update(len(data_buf))
-                out.write(repr(p) + "\r")
-                out.flush()
-            else:
-                time.sleep(.1)
+        renderer = io.ProgressRenderer(out)
+        p = io.Progress(sz, "dump", (renderer,) + tuple(listeners))
+        sum = Checksum()
+        with renderer:
+            while len(data_buf) < sz:
+                # Don't overflow the buffer
+                tr = self.port.read(min(sz - len(data_buf), 128))
+                if tr != '':
+                    data_buf.fromstring(tr)
+                    sum.update(tr)
+                    p.update(len(data_buf))
+                else:
+                    time.sleep(.1)
 
         # Two nulls + checksum
         trailer = array.array("B")
@@ -280,18 +358,33 @@ class Yar():
             trailer.fromstring(self.port.read(1))
 
         prog_sum = (trailer[2] << 8) + trailer[3]
-        pload_sum = checksum(data_buf) & 0xFFFF
+        pload_sum = sum.programmer_sum()
         if prog_sum != pload_sum:
             raise IOError("Programmer cksum %04x != data cksum %04x" % (
                 prog_sum, pload_sum))
-        data_buf.tofile(outp)
-
-    def load_from(self, inp, progress_to=None):
-        """Load programmer RAM from file-like object."""
-        out = progress_to or sys.stderr
-        bytes = io.file_to_bytes(inp)
-        p = io.Progress(len(bytes))
-        sum = checksum(bytes) & 0xFFFF
+        return data_buf
+
+    def load_from(self, inp, progress_to=None, listeners=()):
+        """Load programmer RAM from file-like object, or an io.Prefetcher.
+
+           The file is read ahead on another thread while it's sent,
+           unless it's a pipe or similar, which has to be read before
+           its length can be sent. Progress is drawn to progress_to, or
+           stderr, and sent to listeners."""
+        source = inp if isinstance(inp, io.Prefetcher) else io.Prefetcher(inp)
+        with source:
+            self._send(source, progress_to or sys.stderr, listeners)
+
+    def _send(self, source, out, listeners):
+        """Send the contents of an io.Prefetcher to programmer RAM."""
+        (size, chunks) = (source.size, source)
+        if size is None:
+            chunks = ["".join(source)]
+            size = len(chunks[0])
+
+        renderer = io.ProgressRenderer(out)
+        p = io.Progress(size, "load", (renderer,) + tuple(listeners))
+        sum = Checksum()
         self.set_format(format.BINARY)
         self._writeline("I")
 
@@ -304,35 +397,36 @@ class Yar():
 
         # Data length
         # FIXME this is stupid but I can't think right now.
-        self.port.write([int(n, 16) for n in '%04x' % len(bytes)])
+        self.port.write([int(n, 16) for n in '%04x' % size])
 
         self.port.write([0xFF])  # Rubout
 
         # Data
         sent = 0
-        while len(bytes) > 0:
-            block = min(128, len(bytes))
-            assert block > 0, "Can't send empty block"
-            loop_bytes = bytes[:block]
-            written = self.port.write(loop_bytes)
-            assert written == block, "Incomplete write"
-            assert self.port.inWaiting() == 0, \
-                "Programmer is trying to tell us something"
-            self.port.flush()
-            sent += written
-            p.update(sent)
-            out.write(repr(p) + "\r")
-            out.flush()
-            bytes = bytes[block:]  # Truncate buffer
-            time.sleep(.1)
-
-        out.write("\n")
-        out.flush()
+        with renderer:
+            for loop_bytes in io.pipeline(chunks, io.reblock(128)):
+                # Only send as much as the header said
+                loop_bytes = loop_bytes[:size - sent]
+                if not loop_bytes:
+                    break
+                written = self.port.write(loop_bytes)
+                assert written == len(loop_bytes), "Incomplete write"
+                sum.update(loop_bytes)
+                assert self.port.inWaiting() == 0, \
+                    "Programmer is trying to tell us something"
+                self.port.flush()
+                sent += written
+                p.update(sent)
+                time.sleep(.1)
+        if sent != size:
+            raise IOError("File shrank while sending: %d of %d bytes" % (
+                sent, size))
 
         # Trailer
         self.port.write([0x00, 0x00])
 
         # Checksum
+        sum = sum.programmer_sum()
         self.port.write([sum >> 8, sum & 0xFF])
 
         self._await()
@@ -4,5 +4,49 @@
 # Author: Ian Eure <ian.eure@gmail.com>
 #
 
+"""Data I/O translation formats, and codecs for the text formats."""
+
+from functools import partial
+import os
+
+from yar.intelhex import IntelHexEncoder, IntelHexDecoder
+from yar.mostech import MOSEncoder, MOSDecoder
+from yar.srec import SRecordEncoder, SRecordDecoder
+
 BINARY = 0x10
 MOSTECH = 0x81
+MOTOROLA_EXORCISER = 0x82       # S1/S9 records, 16-bit addresses
+INTEL_HEX = 0x83                # Intel Intellec 8/MDS
+MOTOROLA_EXORMAX = 0x87         # S2/S8 records, 24-bit addresses
+INTEL_HEX_86 = 0x88             # Intel MCS-86 Hexadecimal Object
+MOTOROLA_32 = 0x95              # S3/S7 records, 32-bit addresses
+
+# (encoder, decoder) classes of the text formats. Encoders have
+# encode_buffer() and finalize(), and decoders have decode_into().
+CODECS = {MOSTECH: (MOSEncoder, MOSDecoder),
+          INTEL_HEX: (IntelHexEncoder, IntelHexDecoder),
+          INTEL_HEX_86: (partial(IntelHexEncoder, segmented=True),
+                         IntelHexDecoder),
+          MOTOROLA_EXORCISER: (partial(SRecordEncoder, address_size=2),
+                               SRecordDecoder),
+          MOTOROLA_EXORMAX: (partial(SRecordEncoder, address_size=3),
+                             SRecordDecoder),
+          MOTOROLA_32: (partial(SRecordEncoder, address_size=4),
+                        SRecordDecoder)}
+
+# Text formats, by file extension
+EXTENSIONS = {".hex": INTEL_HEX,
+              ".ihx": INTEL_HEX,
+              ".mos": MOSTECH,
+              ".s19": MOTOROLA_EXORCISER,
+              ".s28": MOTOROLA_EXORMAX,
+              ".s37": MOTOROLA_32,
+              ".srec": MOTOROLA_32,
+              ".mot": MOTOROLA_32}
+
+
+def by_path(path):
+    """Return the format of path, by its extension.
+
+       Files without the extension of a text format are BINARY."""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), BINARY)
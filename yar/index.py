@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+"""ROM identification index.
+
+   The index records the size, checksum, CRC32 and SHA1 of known ROMs,
+   so dumps can be identified without scanning the library."""
+
+import os
+import sqlite3
+
+# Digests recorded for each ROM
+DIGESTS = ("sum", "crc32", "sha1")
+
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS roms (
+                 name TEXT PRIMARY KEY,
+                 size INTEGER NOT NULL,
+                 sum INTEGER NOT NULL,
+                 crc32 INTEGER NOT NULL,
+                 sha1 BLOB NOT NULL)""",
+          "CREATE INDEX IF NOT EXISTS roms_sha1 ON roms (sha1)",
+          "CREATE INDEX IF NOT EXISTS roms_crc32 ON roms (crc32, size)",
+          "CREATE INDEX IF NOT EXISTS roms_sum ON roms (sum, size)")
+
+
+def default_path():
+    """Return the default location of the index."""
+    base = (os.environ.get("XDG_DATA_HOME") or
+            os.path.join(os.path.expanduser("~"), ".local", "share"))
+    return os.path.join(base, "yar", "index.sqlite")
+
+
+def pack(size, digests):
+    """Return a row of (size, sum, crc32, sha1) for hex digests."""
+    return (size, int(digests["sum"], 16), int(digests["crc32"], 16),
+            sqlite3.Binary(digests["sha1"].decode("hex")))
+
+
+class Index():
+
+    """An index of known ROMs, stored in SQLite."""
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        dir_ = os.path.dirname(self.path)
+        if dir_ and not os.path.isdir(dir_):
+            os.makedirs(dir_)
+        self.db = sqlite3.connect(self.path)
+        for stmt in SCHEMA:
+            self.db.execute(stmt)
+
+    def add(self, name, size, digests):
+        """Record a ROM, given a dict of hex DIGESTS."""
+        self.db.execute("INSERT OR REPLACE INTO roms VALUES (?, ?, ?, ?, ?)",
+                        (name,) + pack(size, digests))
+
+    def identify(self, size, digests):
+        """Return a list of (name, match) for ROMs matching digests.
+
+           Matches are by SHA1 if possible, then by CRC32 and size,
+           and finally by checksum and size; match is the digest which
+           matched."""
+        (size, sum, crc32, sha1) = pack(size, digests)
+        for (match, where, args) in (
+                ("sha1", "sha1 = ?", (sha1,)),
+                ("crc32", "crc32 = ? AND size = ?", (crc32, size)),
+                ("sum", "sum = ? AND size = ?", (sum, size))):
+            names = [name for (name,) in self.db.execute(
+                "SELECT name FROM roms WHERE " + where + " ORDER BY name",
+                args)]
+            if names:
+                return [(name, match) for name in names]
+        return []
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM roms").fetchone()[0]
+
+    def close(self):
+        """Write pending changes and close the index."""
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+"""Intel HEX codecs"""
+
+import binascii
+import struct
+
+from yar.cksum import buffer_sum
+import yar.io as io
+
+# Record types
+DATA = 0x00
+EOF = 0x01
+EXTENDED_SEGMENT = 0x02
+START_SEGMENT = 0x03
+EXTENDED_LINEAR = 0x04
+START_LINEAR = 0x05
+
+
+def record(type, address, data=""):
+    """Return an Intel HEX record, without an EOL."""
+    rec = bytearray(struct.pack(">BHB", len(data), address, type)) + data
+    rec.append(-buffer_sum(rec) & 0xFF)
+    return ":" + binascii.hexlify(rec).upper()
+
+
+class IntelHexEncoder():
+
+    """Encodes bytes as Intel HEX records.
+
+       Data past 64KiB is addressed with extended linear address
+       records, or, if segmented is set, with extended segment address
+       records, which reach 1MiB. Records never cross a 64KiB
+       boundary.
+
+       All state is per-instance, as with MOSEncoder."""
+
+    def __init__(self, record_size=16, eol="\n", segmented=False):
+        self.record_size = record_size
+        self.eol = eol
+        self.segmented = segmented
+        self.reset()
+
+    def reset(self):
+        """Forget everything encoded, to start a new file."""
+        self.address = 0
+        self.lines = []
+        self._window = 0        # Upper bits of the addresses of records
+
+    def _set_window(self, window):
+        """Add an extended address record, if window has changed."""
+        if window == self._window:
+            return
+        if self.segmented:
+            if window > 0xF:
+                raise ValueError("Can't address %x with segments" % (
+                    window << 16))
+            self.lines.append(record(EXTENDED_SEGMENT, 0,
+                                     struct.pack(">H", window << 12)))
+        else:
+            self.lines.append(record(EXTENDED_LINEAR, 0,
+                                     struct.pack(">H", window)))
+        self._window = window
+
+    def encode_buffer(self, data, address=None):
+        """Encode a buffer at address, or after the last one encoded.
+
+           The buffer is converted to hex in one go, and each record
+           is sliced from that."""
+        if address is not None:
+            self.address = address
+        (hex, data, off) = (binascii.hexlify(data).upper(), bytearray(data), 0)
+        while off < len(data):
+            if self.address > 0xFFFFFFFF:
+                raise ValueError("Can't address %x" % self.address)
+            self._set_window(self.address >> 16)
+            low = self.address & 0xFFFF
+            rs = min(self.record_size, len(data) - off, 0x10000 - low)
+            cksum = -(rs + (low >> 8) + (low & 0xFF) +
+                      buffer_sum(data[off:off + rs])) & 0xFF
+            self.lines.append(":%02X%04X%02X%s%02X" % (
+                rs, low, DATA, hex[off * 2:(off + rs) * 2], cksum))
+            (off, self.address) = (off + rs, self.address + rs)
+
+    def flush(self):
+        """Return the records encoded since the last flush.
+
+           Large images can be encoded a piece at a time, flushing
+           the records of each piece to a file."""
+        out = "".join(line + self.eol for line in self.lines)
+        self.lines = []
+        return out
+
+    def finalize(self):
+        """Return the remaining records, and the end of file record."""
+        self.lines.append(record(EOF, 0))
+        return self.flush()
+
+
+class IntelHexDecoder():
+
+    """Decodes Intel HEX records.
+
+       Each record's checksum is verified. The start address from a
+       start segment (CS:IP, as a 32-bit integer) or start linear
+       address record is kept in start. As with MOSDecoder, all state
+       is per-instance."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything decoded, to start a new file."""
+        self.record = 0
+        self.base = 0           # Address of the current segment or window
+        self.start = None
+        self.done = False
+
+    def decode(self, line):
+        """Decode a record, returning its (address, payload).
+
+           Returns None for records other than data records."""
+        if line[:1] != ":":
+            raise ValueError("Invalid input on line %d" % self.record)
+        try:
+            rec = bytearray(binascii.unhexlify(line[1:]))
+        except TypeError:
+            raise ValueError("Invalid data on line %d" % self.record)
+        if len(rec) < 5 or len(rec) != rec[0] + 5:
+            raise ValueError("Bad record length on line %d" % self.record)
+        if buffer_sum(rec) & 0xFF:
+            raise ValueError("Checksum mismatch on line %d" % self.record)
+        self.record += 1
+
+        (type, payload) = (rec[3], rec[4:-1])
+        if type == DATA:
+            return (self.base + ((rec[1] << 8) | rec[2]), payload)
+
+        if type == EOF:
+            self.done = True
+        elif type in (EXTENDED_SEGMENT, EXTENDED_LINEAR) and len(payload) == 2:
+            shift = 4 if type == EXTENDED_SEGMENT else 16
+            self.base = ((payload[0] << 8) | payload[1]) << shift
+        elif type in (START_SEGMENT, START_LINEAR) and len(payload) == 4:
+            self.start = struct.unpack(">I", str(payload))[0]
+        else:
+            raise ValueError("Invalid record type %02x on line %d" % (
+                type, self.record - 1))
+        return None
+
+    def gen_records(self, lines):
+        """Return a generator of (address, payload) for data records.
+
+           lines is an iterable of lines, like a file. It stops at the
+           end of file record."""
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = self.decode(line)
+            if self.done:
+                return
+            if record:
+                yield record
+
+    def decode_into(self, lines, out, offset=0):
+        """Decode records from lines, writing each at its address in out.
+
+           Records are written at their address less offset, with
+           io.addressed_writer(). Returns the end address of the
+           highest record."""
+        write = io.addressed_writer(out, offset)
+        end = 0
+        for (addr, payload) in self.gen_records(lines):
+            write(addr, payload)
+            end = max(end, addr + len(payload))
+        return end
@@ -7,35 +7,563 @@
 """IO functions"""
 
 from array import array
-from contextlib import closing
+from collections import namedtuple
+from contextlib import closing, contextmanager
+import copy
+from cStringIO import StringIO
+from fnmatch import fnmatch
+from functools import partial
+import math
+import mmap
+import os
+import Queue
+import stat
+import sys
+import tarfile
+import tempfile
+import threading
 import zipfile
 import time
 
-def file_to_bytes(inp, bs=4096):
-    """Return an array of bytes read from inp."""
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from yar.cksum import MultiDigest
+
+XZ_MAGIC = "\xfd7zXZ\x00"
+
+# Magic numbers of gzip, bzip2 and xz, and names of tar archives they
+# compress
+COMPRESSED_MAGIC = ("\x1f\x8b", "BZh", XZ_MAGIC)
+COMPRESSED_TAR_SUFFIXES = (".tar.gz", ".tgz", ".tar.bz2", ".tbz2",
+                           ".tar.xz", ".txz")
+
+READ_SIZE = 2**20               # Largest single read into a buffer
+
+
+def size_of(inp):
+    """Return the number of bytes left in inp, or None if unknown."""
+    try:
+        st = os.fstat(inp.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return max(st.st_size - inp.tell(), 0)
+    except (AttributeError, EnvironmentError, ValueError):
+        pass
+    return None
+
+
+def file_to_bytes(inp, bs=4096, size=None):
+    """Return an array of bytes read from inp.
+
+       If size is given, or inp is a plain file, the bytes are read
+       into a buffer of that size, rather than bs bytes at a time."""
     buf = array("B")
-    done = False
-    while not done:
-        temp = inp.read(bs)
-        buf.fromstring(temp)
-        done = len(temp) < bs
+    if size is None:
+        size = size_of(inp)
+    if size is not None:
+        buf.fromstring(read_buffer(inp, size))
+        return buf
+
+    for chunk in gen_chunks(inp, bs):
+        buf.fromstring(chunk)
     return buf
 
 
-def gen_fds(args, unzip=True):
+def read_into(inp, buf, bs=READ_SIZE):
+    """Fill buf from inp, returning the number of bytes read.
+
+       Reads are at most bs bytes."""
+    view = memoryview(buf)
+    done = 0
+    while done < len(buf):
+        n = inp.readinto(view[done:done + bs])
+        if not n:
+            break
+        done += n
+    return done
+
+
+def read_buffer(inp, size=None):
+    """Return a read-only buffer of the rest of inp.
+
+       If size is known, it's read into a single preallocated buffer."""
+    if size is None:
+        size = size_of(inp)
+    if size is None or not hasattr(inp, "readinto"):
+        return buffer(inp.read())
+    buf = bytearray(size)
+    n = read_into(inp, buf)
+    if n == size:
+        # There may be more than we were told
+        rest = inp.read()
+        if rest:
+            return buffer(buf + rest)
+    return buffer(buf, 0, n)
+
+
+@contextmanager
+def load_buffer(inp, size=None):
+    """Return a context manager for a read-only buffer of the rest of inp.
+
+       Plain files are memory-mapped, without copying, and unmapped
+       when the with block ends, so the buffer can't be used after it.
+       Anything else, like ZIP members or pipes, is read with
+       read_buffer(). Either way, inp is left at its end."""
+    try:
+        st = os.fstat(inp.fileno())
+    except (AttributeError, EnvironmentError, ValueError):
+        st = None
+
+    if st and stat.S_ISREG(st.st_mode) and st.st_size > inp.tell():
+        map_ = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = inp.tell()
+            inp.seek(0, os.SEEK_END)
+            yield buffer(map_, offset)
+        finally:
+            map_.close()
+        return
+    yield read_buffer(inp, size)
+
+
+def gen_chunks(inp, bs=2**16):
+    """Return a generator of strings of up to bs bytes read from inp."""
+    while True:
+        chunk = inp.read(bs)
+        if not chunk:
+            return
+        yield chunk
+
+
+def digest_entry(entry, names):
+    """Return a dict of name -> hex digest of an entry's contents.
+
+       The entry is read once, however many digests are named. See
+       yar.cksum.MultiDigest for the names."""
+    md = MultiDigest(names)
+    with entry.open() as fd:
+        drain(pipeline(gen_views(fd), digest(md)))
+    return md.hexdigests()
+
+
+def gen_views(inp, bs=2**16):
+    """Return a generator of memoryview chunks of up to bs bytes of inp.
+
+       Chunks are read into one reused buffer, so each is only valid
+       until the next one is read."""
+    if not hasattr(inp, "readinto"):
+        for chunk in gen_chunks(inp, bs):
+            yield memoryview(chunk)
+        return
+
+    view = memoryview(bytearray(bs))
+    while True:
+        n = inp.readinto(view)
+        if not n:
+            return
+        yield view[:n]
+
+
+ # Chunk pipelines
+#
+# A pipeline is a source, like gen_views(), followed by stages. Each
+# stage is a function which takes an iterable of chunks and returns a
+# generator of chunks, so stages can be chained, and chunks are
+# processed as they are read.
+
+def pipeline(source, *stages):
+    """Return a generator of the chunks from source, through stages."""
+    for stage in stages:
+        source = stage(source)
+    return source
+
+
+def drain(chunks):
+    """Consume a pipeline, returning the number of bytes in it."""
+    return sum(len(chunk) for chunk in chunks)
+
+
+def digest(*hashers):
+    """Return a stage which updates hashers with each chunk."""
+    def stage(chunks):
+        for chunk in chunks:
+            for h in hashers:
+                h.update(chunk)
+            yield chunk
+    return stage
+
+
+def transform(fn, finish=None):
+    """Return a stage which yields fn(chunk) for each chunk.
+
+       If finish is set, it's called after the last chunk, and returns
+       a final chunk, e.g. to flush an encoder."""
+    def stage(chunks):
+        for chunk in chunks:
+            out = fn(chunk)
+            if out:
+                yield out
+        tail = finish and finish()
+        if tail:
+            yield tail
+    return stage
+
+
+def sink(outp):
+    """Return a stage which writes each chunk to outp.
+
+       outp.write() must accept buffers, as files do."""
+    def stage(chunks):
+        for chunk in chunks:
+            outp.write(chunk)
+            yield chunk
+    return stage
+
+
+def reblock(size):
+    """Return a stage which yields size-byte blocks of the chunks.
+
+       The last block is short if the chunks don't add up to a multiple
+       of size. Chunks must be strs or buffers."""
+    def stage(chunks):
+        pending = ""
+        for chunk in chunks:
+            if pending:
+                chunk = pending + str(chunk)
+            end = len(chunk) - len(chunk) % size
+            for off in xrange(0, end, size):
+                yield chunk[off:off + size]
+            pending = chunk[end:]
+        if pending:
+            yield pending
+    return stage
+
+
+def addressed_writer(out, offset=0):
+    """Return a function which writes data at an address in out.
+
+       The function is called with (address, data), and writes data at
+       address - offset. out is a file opened for writing, or a
+       writable buffer (bytearray, mmap or array('B')) large enough
+       for every write. This is how decoders of addressed records, like
+       MOSDecoder, write them out."""
+    def position(addr):
+        if addr < offset:
+            raise ValueError("Record at %x is before the start, %x" % (
+                addr, offset))
+        return addr - offset
+
+    if hasattr(out, "seek"):
+        def write(addr, data):
+            out.seek(position(addr))
+            out.write(data)
+        return write
+
+    def write(addr, data):
+        pos = position(addr)
+        if pos + len(data) > len(out):
+            raise ValueError("Record at %x doesn't fit in %d-byte buffer" % (
+                addr, len(out)))
+        if isinstance(out, array):
+            data = array("B", str(data))
+        out[pos:pos + len(data)] = data
+    return write
+
+
+class Prefetcher():
+
+    """A source which reads a file ahead of its consumer.
+
+       The file is read in bs-byte chunks on a background thread, into
+       a queue of up to depth chunks, so reading it overlaps with
+       whatever is done with the chunks. size is the number of bytes
+       left in the file, or None if that can't be known without
+       reading it. Errors reading the file are raised when the chunk
+       after the last one read is reached.
+
+       Use it as a context manager, to stop the thread if the chunks
+       aren't all consumed."""
+
+    def __init__(self, inp, bs=2**16, depth=16):
+        self.size = size_of(inp)
+        self._inp = inp
+        self._bs = bs
+        self._queue = Queue.Queue(depth)
+        self._stop = threading.Event()
+        self._error = None
+        self._done = False
+        self._thread = threading.Thread(target=self._run, name="prefetch")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._inp.read(self._bs)
+                if not chunk:
+                    break
+                self._put(chunk)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        while not self._done:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._done = True
+                if self._error:
+                    raise self._error[0], self._error[1], self._error[2]
+                return
+            yield chunk
+
+    def close(self):
+        """Stop reading ahead."""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def scan_dir(dir_):
+    """Return lists of the (files, subdirectories) in dir_, sorted.
+
+       Files are (path, stat) tuples, where stat is a function
+       returning the stat result of the file. It's cached where the
+       directory scan provides it, to save a system call per file.
+       Symlinks to directories aren't followed."""
+    (files, dirs) = ([], [])
+    if scandir is not None:
+        for e in scandir(dir_):
+            if e.is_dir(follow_symlinks=False):
+                dirs.append(e.path)
+            else:
+                files.append((e.path, e.stat))
+    else:
+        for name in os.listdir(dir_):
+            path = os.path.join(dir_, name)
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(path)
+            elif stat.S_ISLNK(st.st_mode):
+                files.append((path, partial(os.stat, path)))
+            else:
+                files.append((path, lambda st=st: st))
+    return (sorted(files), sorted(dirs))
+
+
+def matches(path, patterns):
+    """Does the basename of path match any of the fnmatch patterns?"""
+    name = os.path.basename(path)
+    return any(fnmatch(name, pat) for pat in patterns)
+
+
+def walk(args, include=(), exclude=()):
+    """Return a generator of (path, stat) for the inputs.
+
+       Directories are walked recursively, in sorted order, yielding
+       the files in each directory before those in its subdirectories.
+       Paths are yielded as they're found, so large trees don't have
+       to be scanned up front.
+
+       Files found in directories are skipped unless they match one of
+       the include patterns, if any are given, and directories and
+       files which match an exclude pattern are skipped. Other inputs
+       are always yielded, with a stat of None. As with os.walk,
+       subdirectories which can't be scanned are skipped."""
+    for arg in args:
+        if not os.path.isdir(arg):
+            yield (arg, None)
+            continue
+
+        (files, dirs) = scan_dir(arg)
+        for found in _walk_scanned(files, dirs, include, exclude):
+            yield found
+
+
+def _walk_scanned(files, dirs, include, exclude):
+    """Return a generator of (path, stat) for a scanned directory."""
+    for (path, stat_fn) in files:
+        if ((include and not matches(path, include)) or
+                matches(path, exclude)):
+            continue
+        try:
+            st = stat_fn()
+        except OSError:
+            continue            # Broken symlink
+        if stat.S_ISREG(st.st_mode):
+            yield (path, st)
+
+    for dir_ in dirs:
+        if matches(dir_, exclude):
+            continue
+        try:
+            (subfiles, subdirs) = scan_dir(dir_)
+        except OSError:
+            continue            # Unreadable, or removed since the scan
+        for found in _walk_scanned(subfiles, subdirs, include, exclude):
+            yield found
+
+
+def gen_paths(args, include=(), exclude=()):
+    """Return a generator of file paths for the inputs.
+
+       Directories are walked recursively, as by walk()."""
+    return (path for (path, _) in walk(args, include, exclude))
+
+
+def is_xz(inp):
+    """Is inp, a path or seekable file, xz-compressed?"""
+    if isinstance(inp, basestring):
+        with open(inp, "rb") as fd:
+            return is_xz(fd)
+    magic = inp.read(len(XZ_MAGIC))
+    inp.seek(-len(magic), 1)
+    return magic == XZ_MAGIC
+
+
+def archive_type(fd, name):
+    """Return "zip" or "tar" if the seekable file fd is an archive.
+
+       Returns None if it isn't. This is worked out from the first
+       block of fd and the end of a ZIP file, rather than by trying to
+       open it. Plain tar archives are recognized by the ustar magic in
+       their header. Compressed ones are recognized by the magic of
+       their compression, but only if name, the path or member name of
+       fd, has a compressed tar suffix, since other compressed files
+       can't be told apart without decompressing them."""
+    try:
+        header = fd.read(tarfile.BLOCKSIZE)
+        if header[257:262] == "ustar":
+            return "tar"
+        if (name.lower().endswith(COMPRESSED_TAR_SUFFIXES) and
+                header.startswith(COMPRESSED_MAGIC)):
+            if header.startswith(XZ_MAGIC) and lzma is None:
+                return None
+            return "tar"
+        fd.seek(0)
+        return zipfile.is_zipfile(fd) and "zip" or None
+    finally:
+        fd.seek(0)
+
+
+def open_tar_stream(fd):
+    """Return a TarFile which reads fd in one sequential pass."""
+    if is_xz(fd):
+        return tarfile.open(fileobj=lzma.LZMAFile(fd), mode="r|")
+    return tarfile.open(fileobj=fd, mode="r|*")
+
+
+class TarMember():
+
+    """A file-like member of a tar archive.
+
+       Unlike the object tarfile returns, this is a context manager."""
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    def __getattr__(self, name):
+        return getattr(self._fd, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self._fd.close()
+
+
+ # Nested archives
+
+# Suffixes of archive members which may be archives themselves
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2",
+                    ".tar.xz", ".txz")
+
+SPOOL_SIZE = 2**24              # Nested archives larger than this go to disk
+
+
+def is_archive_name(name):
+    """Does name look like an archive?"""
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def spool(inp):
+    """Return a seekable temporary file with the rest of inp in it.
+
+       Up to SPOOL_SIZE bytes are kept in memory; more are spilled to
+       disk."""
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in gen_chunks(inp):
+        out.write(chunk)
+    out.seek(0)
+    return out
+
+
+def gen_fds(args, unzip=True, depth=0):
     """Return a generator of tuples of (filename, fd) for the inputs.
 
-       If unzip is set to False, ZIP files will be checksummed, rather
-       than the files inside them."""
+       If unzip is set to False, ZIP files and tar archives will be
+       checksummed, rather than the files inside them. Archives inside
+       archives are opened up to depth levels deep."""
     for inpf in args:
         with open(inpf, "rb") as fd:
-            if unzip and zipfile.is_zipfile(inpf):
-                yield gen_zip_fds(inpf, fd)
+            kind = unzip and archive_type(fd, inpf)
+            if kind == "zip":
+                yield gen_zip_fds(inpf, fd, depth)
+            elif kind == "tar":
+                yield gen_tar_fds(inpf, fd, depth)
             else:
                 yield ((inpf, fd),)
 
 
-def gen_zip_fds(inpf, fd):
+def gen_member_fds(name, fd, depth=0):
+    """Return a generator of (filename, fd) for an archive member.
+
+       If depth > 0 and the member is an archive, it's spooled, and
+       the files inside it are returned instead."""
+    if depth <= 0 or not is_archive_name(name):
+        yield (name, fd)
+        return
+
+    with closing(spool(fd)) as sfd:
+        kind = archive_type(sfd, name)
+        if kind == "zip":
+            members = gen_zip_fds(name, sfd, depth - 1)
+        elif kind == "tar":
+            members = gen_tar_fds(name, sfd, depth - 1)
+        else:
+            members = ((name, sfd),)
+        for member in members:
+            yield member
+
+
+def gen_zip_fds(inpf, fd, depth=0):
     """Return a generator of (filename, fd).
 
        The generator returns the files inside the ZIP archive.
@@ -43,52 +571,529 @@ def gen_zip_fds(inpf, fd):
     with closing(zipfile.ZipFile(fd)) as zfd:
         for zfn in zfd.namelist():
             with closing(zfd.open(zfn)) as fd:
-                yield ("%s:%s" % (inpf, zfn), fd)
+                for member in gen_member_fds("%s:%s" % (inpf, zfn), fd,
+                                             depth):
+                    yield member
+
+
+def gen_tar_fds(inpf, fd, depth=0):
+    """Return a generator of (filename, fd).
+
+       The generator returns the files inside the tar archive, which
+       is read in a single pass. Each fd is only valid until the next
+       one is returned."""
+    with closing(open_tar_stream(fd)) as tfd:
+        for info in tfd:
+            if info.isfile():
+                with TarMember(tfd.extractfile(info)) as fd:
+                    for member in gen_member_fds(
+                            "%s:%s" % (inpf, info.name), fd, depth):
+                        yield member
+
+
+class FileEntry():
+
+    """A plain file to be read."""
+
+    def __init__(self, path, st=None):
+        self.path = path
+        self.name = path
+        self.stat = st or os.stat(path)
+        self.size = self.stat.st_size
+
+    def key(self):
+        """Return a (path, ident, size) tuple identifying the contents."""
+        return (os.path.abspath(self.path), "m%r" % self.stat.st_mtime,
+                self.size)
+
+    def open(self):
+        """Return a file-like object for the contents."""
+        return open(self.path, "rb")
+
+    def read(self):
+        """Return a read-only buffer of the contents."""
+        with self.open() as fd:
+            return read_buffer(fd, self.size)
+
+
+def archive_name(archive):
+    """Return the name of archive, a path or the entry of a nested one."""
+    return getattr(archive, "name", archive)
+
+
+def archive_key(archive, ident):
+    """Return the (path, ident) key of a member of archive.
+
+       archive is a path, or the entry of a nested archive. Members of
+       nested archives are keyed by the outermost archive's path, and
+       the idents of each archive they're in, separated by colons."""
+    if isinstance(archive, basestring):
+        return (os.path.abspath(archive), ident)
+    (path, parent, _) = archive.key()
+    return (path, "%s:%s" % (parent, ident))
+
+
+def archive_file(archive):
+    """Return a path or file to open archive from.
+
+       Nested archives are spooled."""
+    if isinstance(archive, basestring):
+        return archive
+    with archive.open() as fd:
+        return spool(fd)
+
+
+_archive_handles = {}            # Archives opened by detached entries
+
+
+def open_archive(archive, opener):
+    """Return an archive opened with opener(archive).
+
+       The most recently used archive is kept open, since members of
+       the same archive are usually read one after another."""
+    name = archive_name(archive)
+    handle = _archive_handles.get(name)
+    if handle is None:
+        for old in _archive_handles.values():
+            old.close()
+        _archive_handles.clear()
+        handle = _archive_handles[name] = opener(archive)
+    return handle
+
+
+def open_zip(archive):
+    """Return an open ZipFile for archive."""
+    return open_archive(
+        archive, lambda archive: zipfile.ZipFile(archive_file(archive)))
+
+
+def open_tar(archive):
+    """Return a TarFile for archive, which can read members in any order.
+
+       Compressed archives are decompressed from the start to reach
+       each member, so this is much slower than reading them in order."""
+    def opener(archive):
+        inp = archive_file(archive)
+        if is_xz(inp):
+            return tarfile.open(fileobj=lzma.LZMAFile(inp), mode="r:")
+        if isinstance(inp, basestring):
+            return tarfile.open(inp, "r:*")
+        return tarfile.open(fileobj=inp, mode="r:*")
+    return open_archive(archive, opener)
+
+
+class ZipEntry():
+
+    """A member of a ZIP archive.
+
+       archive is the path of the archive, or the entry of a nested
+       one. The entry reads from the archive handle it was created
+       with. If it's detached with detach() or pickled, e.g. to send
+       to another process, the handle is left behind, and the archive
+       is opened again when needed."""
+
+    def __init__(self, archive, info, zfd=None):
+        self.archive = archive
+        self.member = info.filename
+        self.crc = info.CRC
+        self.name = "%s:%s" % (archive_name(archive), info.filename)
+        self.size = info.file_size
+        self._zfd = zfd
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_zfd"] = None
+        return state
+
+    def key(self):
+        """Return a (path, ident, size) tuple identifying the contents."""
+        return archive_key(self.archive, "c%08x" % self.crc) + (self.size,)
+
+    def open(self):
+        """Return a file-like object for the contents."""
+        return (self._zfd or open_zip(self.archive)).open(self.member)
+
+    def read(self):
+        """Return a read-only buffer of the contents."""
+        with self.open() as fd:
+            return read_buffer(fd, self.size)
+
+
+class TarEntry():
+
+    """A member of a tar archive.
+
+       archive is the path of the archive, or the entry of a nested
+       one. Tar archives are read in a single pass, so the entry can
+       only be opened from the stream it was created with until the
+       next entry is read. Detached or pickled entries open the
+       archive again, with open_tar(), unless their contents were kept
+       by detach() or keep_tar_members()."""
+
+    def __init__(self, archive, info, mtime=None, tfd=None):
+        self.archive = archive
+        self.member = info.name
+        self.mtime = mtime
+        self.name = "%s:%s" % (archive_name(archive), info.name)
+        self.size = info.size
+        self._info = info
+        self._tfd = tfd
+        self._data = None       # Contents, if kept
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_info"] = state["_tfd"] = None
+        return state
+
+    def key(self):
+        """Return a (path, ident, size) tuple identifying the contents.
+
+           Tar archives have no member checksums, so the ident is the
+           archive's modification time and the member name. Nested
+           archives are already identified by their parent."""
+        if self.mtime is None:
+            ident = self.member
+        else:
+            ident = "m%r:%s" % (self.mtime, self.member)
+        return archive_key(self.archive, ident) + (self.size,)
+
+    def open(self):
+        """Return a file-like object for the contents."""
+        if self._data is not None:
+            return TarMember(StringIO(self._data))
+        if self._tfd:
+            return TarMember(self._tfd.extractfile(self._info))
+        return TarMember(open_tar(self.archive).extractfile(self.member))
+
+    def read(self):
+        """Return a read-only buffer of the contents."""
+        with self.open() as fd:
+            return read_buffer(fd, self.size)
+
+
+def detach(entry, keep=False):
+    """Return a copy of entry which can be read once its archive is closed.
+
+       As when it's pickled, the entry's archive handle is left behind,
+       and so are those of any archives it's nested in, so the whole
+       chain is opened again when it's read. If keep is set, a tar
+       member still on its stream is read now, and keeps its contents,
+       rather than decompressing the archive from the start again."""
+    data = None
+    if keep and isinstance(entry, TarEntry) and entry._tfd:
+        with entry.open() as fd:
+            data = fd.read()
+    entry = copy.copy(entry)
+    if data is not None:
+        entry._data = data
+    if not isinstance(getattr(entry, "archive", ""), basestring):
+        entry.archive = detach(entry.archive)
+    return entry
+
+
+def keep_tar_members(entries):
+    """Keep the contents of the detached tar members among entries.
+
+       The members of each archive are read in one sequential pass,
+       rather than each decompressing the archive from the start with
+       open_tar(), and their contents go with them if they're pickled."""
+    by_archive = {}
+    for entry in entries:
+        if isinstance(entry, TarEntry) and entry._data is None and \
+                not entry._tfd:
+            by_archive.setdefault(archive_name(entry.archive), []).append(
+                entry)
+
+    for members in by_archive.itervalues():
+        wanted = {}
+        for entry in members:
+            wanted.setdefault(entry.member, []).append(entry)
+        inp = archive_file(members[0].archive)
+        if isinstance(inp, basestring):
+            inp = open(inp, "rb")
+        with closing(inp), closing(open_tar_stream(inp)) as tfd:
+            for info in tfd:
+                if info.isfile() and info.name in wanted:
+                    data = tfd.extractfile(info).read()
+                    for entry in wanted[info.name]:
+                        entry._data = data
+
+
+def gen_entries(args, unzip=True, depth=0):
+    """Return a generator of entries for the inputs.
+
+       Entries are yielded in the same order as gen_fds() would yield
+       their file descriptors. If unzip is set to False, ZIP files and
+       tar archives are yielded as plain files, rather than the files
+       inside them. Archives inside archives are opened up to depth
+       levels deep.
+
+       The inputs are paths, or (path, stat) tuples as from walk()."""
+    for inpf in args:
+        (inpf, st) = inpf if isinstance(inpf, tuple) else (inpf, None)
+        if unzip:
+            with open(inpf, "rb") as fd:
+                kind = archive_type(fd, inpf)
+                if kind:
+                    for entry in gen_archive_entries(inpf, fd, kind, depth):
+                        yield entry
+                    continue
+        yield FileEntry(inpf, st)
+
+
+def gen_archive_entries(archive, fd, kind, depth=0):
+    """Return a generator of entries for the members of an archive.
+
+       archive is the path of the archive, or the entry of a nested
+       one; fd is a file to read it from, and kind is "zip" or "tar"."""
+    if kind == "zip":
+        with closing(zipfile.ZipFile(fd)) as zfd:
+            for info in zfd.infolist():
+                for entry in gen_nested_entries(ZipEntry(archive, info, zfd),
+                                                depth):
+                    yield entry
+        return
+
+    mtime = None
+    if isinstance(archive, basestring):
+        mtime = os.stat(archive).st_mtime
+    with closing(open_tar_stream(fd)) as tfd:
+        for info in tfd:
+            if info.isfile():
+                for entry in gen_nested_entries(
+                        TarEntry(archive, info, mtime, tfd), depth):
+                    yield entry
+
+
+def gen_nested_entries(entry, depth):
+    """Return a generator of the entry of an archive member.
+
+       If depth > 0 and the member is an archive, it's spooled, and
+       the entries inside it are returned instead."""
+    if depth <= 0 or not is_archive_name(entry.member):
+        yield entry
+        return
+
+    with entry.open() as fd:
+        sfd = spool(fd)
+    with closing(sfd):
+        kind = archive_type(sfd, entry.member)
+        if not kind:
+            # Spooling used up a streamed member, so read it again
+            yield detach(entry)
+            return
+        for nested in gen_archive_entries(entry, sfd, kind, depth - 1):
+            yield nested
+
+
+def same_size(entries):
+    """Return a list of the entries whose size another entry shares.
+
+       Sizes come from stat results and archive directories, so no
+       data is read to find them. The entries are detached, so they can be read
+       after the archives they're in have been closed, and returned in
+       their original order. Empty entries are skipped.
+
+       Tar members which share a size are read in one pass over each
+       archive, with keep_tar_members(), so they keep their contents."""
+    (by_size, order) = ({}, [])
+    for entry in entries:
+        if entry.size:
+            entry = detach(entry)
+            by_size.setdefault(entry.size, []).append(entry)
+            order.append(entry)
+    same = [entry for entry in order if len(by_size[entry.size]) > 1]
+    keep_tar_members(same)
+    return same
+
+
+class ProgressEvent(namedtuple("ProgressEvent", (
+        "phase", "done", "total", "rate", "smoothed", "average", "elapsed",
+        "finished"))):
+
+    """A snapshot of a Progress, as sent to listeners.
+
+       done and total are in bytes; total is None for operations of
+       unknown length, like programming a device. rate is the rate
+       since the last update, smoothed its moving average, and average
+       the rate over the whole operation, all in bytes/sec. elapsed is
+       in seconds."""
+
+    __slots__ = ()
+
+    def percent_done(self):
+        if not self.total:
+            return 100 if self.finished else 0
+        return int((float(self.done) / self.total) * 100)
+
+    def eta(self):
+        """Return (minutes, seconds) remaining, or None if unknown."""
+        if self.total is None or self.smoothed <= 0:
+            return None
+        return divmod(int((self.total - self.done) / self.smoothed), 60)
+
+    def __str__(self):
+        dur = divmod(int(self.elapsed), 60)
+        if self.total is None:
+            return "%s: %s%dm%02ds%s" % (
+                self.phase, "done in " if self.finished else "",
+                dur[0], dur[1], "" if self.finished else " elapsed")
+
+        if self.finished:
+            return "%d bytes in %dm%02ds @%db/s" % (
+                (self.total,) + dur + (self.average,))
+
+        eta = self.eta()
+        return "[%d/%d] bytes, %02d%% @%db/s, eta %s" % (
+            self.done, self.total, self.percent_done(), self.smoothed,
+            "%dm%02ds" % eta if eta else "--")
 
 
 class Progress():
 
-    """An object representing progress."""
+    """An object representing progress.
+
+       Alongside the average rate, this keeps an exponential moving
+       average of the instantaneous rate, which the ETA is based on, so
+       it doesn't jump around when the transfer stalls briefly.
+
+       Listeners are callables, which are called with a ProgressEvent
+       whenever the progress changes. They're called on the thread
+       doing the work, so they should be quick."""
 
     _start = 0                  # Time the process started
     _finish = None              # Time the process finished
     _bytes = 0                  # Bytes to process
     _done = 0                   # Bytes processed
+    _rate = None                # Smoothed bytes/sec
+    _instant = 0                # Bytes/sec since the last sample
+    _last = None                # (time, bytes processed) at last sample
+
+    SMOOTHING = 2.0             # Time constant of the smoothed rate, in secs
 
-    def __init__(self, bytes):
+    def __init__(self, bytes, phase=None, listeners=()):
         self._bytes = bytes
+        self.phase = phase
+        self.listeners = list(listeners)
+
+    def notify(self):
+        """Send the current state to all listeners."""
+        if self.listeners:
+            event = self.event()
+            for listener in self.listeners:
+                listener(event)
 
     def start(self):
         """Start processing"""
         self._start = time.time()
+        self.notify()
 
     def complete(self):
         self._finish = time.time()
+        self.notify()
 
     def update(self, processed):
         """Update the number of bytes processed."""
+        now = time.time()
         if self._start == 0:
-            self._start = time.time()
+            self._start = now
+        (then, done) = self._last or (self._start, 0)
+        if now > then:
+            self._instant = (processed - done) / (now - then)
+            if self._rate is None:
+                self._rate = self._instant
+            else:
+                weight = 1 - math.exp(-(now - then) / self.SMOOTHING)
+                self._rate += weight * (self._instant - self._rate)
+            self._last = (now, processed)
+
         self._done = processed
         if self._done == self._bytes:
-            self.complete()
+            self._finish = now
+        self.notify()
+
+    def elapsed(self):
+        """Return the seconds spent processing."""
+        if self._start == 0:
+            return 0
+        return (self._finish or time.time()) - self._start
 
     def bytes_sec(self):
-        return self._done / (time.time() - self._start)
+        """Return the average rate, in bytes/sec."""
+        elapsed = self.elapsed()
+        return self._done / elapsed if elapsed > 0 else 0
+
+    def rate(self):
+        """Return the smoothed rate, in bytes/sec."""
+        return self._rate if self._rate is not None else self.bytes_sec()
+
+    def event(self):
+        """Return a ProgressEvent of the current state."""
+        return ProgressEvent(self.phase, self._done, self._bytes,
+                             self._instant, self.rate(), self.bytes_sec(),
+                             self.elapsed(), self._finish is not None)
 
     def percent_done(self):
-        return int((float(self._done) / self._bytes) * 100)
+        return self.event().percent_done()
 
     def eta(self):
-        msecs_rem = (self._bytes - self._done) / self.bytes_sec()
-        return (msecs_rem / 60, msecs_rem % 60)
+        """Return (minutes, seconds) remaining, or None if unknown."""
+        return self.event().eta()
 
     def __repr__(self):
-        if self._finish:
-            dur = self._finish - self._start
-            return "%d bytes in %dm%02ds @%db/s" % (
-                self._bytes, dur / 60, dur % 60, self.bytes_sec())
+        return str(self.event())
+
+
+class ProgressRenderer():
+
+    """A progress listener which draws to a stream at a fixed frame rate.
+
+       Drawing happens on a background thread, so a slow terminal
+       never holds up the code sending events. Use it as a context
+       manager around the operation; on exit, the last event is drawn
+       and the line ended. If out is None, nothing is drawn."""
+
+    def __init__(self, out, fps=10):
+        self.out = out
+        self.interval = 1.0 / fps
+        self._event = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, event):
+        self._event = event
+
+    def render(self, end="\r"):
+        """Draw the last event now."""
+        if self._event is not None:
+            self.out.write(str(self._event) + end)
+            self.out.flush()
+
+    def _run(self):
+        last = None
+        while not self._stop.wait(self.interval):
+            if self._event is not last:
+                last = self._event
+                self.out.write(str(last) + "\r")
+                self.out.flush()
+
+    def start(self):
+        if self.out and not self._thread:
+            self._thread = threading.Thread(target=self._run,
+                                            name="progress")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.render("\n")
+
+    def __enter__(self):
+        self.start()
+        return self
 
-        args = (self._done, self._bytes, self.percent_done(),
-                self.bytes_sec()) + self.eta()
-        return "[%d/%d] bytes, %02d%% @%db/s, eta %dm%02ds" % args
+    def __exit__(self, *_):
+        self.stop()
@@ -7,72 +7,169 @@
 """MOS codecs"""
 
 import array
-from yar.cksum import checksum
+import binascii
+from yar.cksum import Checksum, buffer_sum, is_buffer
+import yar.io as io
+
+# Records have 16-bit addresses
+ADDRESS_LIMIT = 0x10000
 
 def sum(self, bytes):
     return reduce(lambda a, b: a + b % 2**256, bytes)
 
 class MOSEncoder():
 
-    record = 0
-    record_size = 16
-    rolling_sum = 0
-    eol = "\n"
-    next_final = False
-    lines = []
+    """Encodes bytes as MOS Technology records.
+
+       All state is per-instance, so encoders can be used from several
+       threads at once, as long as each has its own."""
 
     def __init__(self, record_size=16, eol="\n"):
         self.record_size = record_size
         self.eol = eol
+        self.reset()
 
-    def encode(self, object):
-        rs = len(object)
+    def reset(self):
+        """Forget everything encoded, to start a new file."""
+        self.record = 0
+        self.rolling_sum = Checksum()
+        self.next_final = False
+        self.lines = []
+
+    def _append(self, rs, hex, total):
+        """Add a record of rs bytes, given their hex and their sum."""
         addr = self.record * self.record_size
-        bytes = "".join(["%02x" % b for b in object])
-        cksum = checksum([rs, addr] + object)
-        self.rolling_sum = checksum([self.rolling_sum, cksum])
+        if addr + rs > ADDRESS_LIMIT:
+            raise ValueError("Can't address %x" % (addr + rs - 1))
+        cksum = Checksum([rs, addr]).value + total
+        self.rolling_sum.update([cksum])
         self.record += 1
-        self.lines.append(";%02x%04x%s%04x" % (rs, addr, bytes, cksum))
+        self.lines.append(";%02x%04x%s%04x" % (rs, addr, hex, cksum))
+
+    def encode(self, object):
+        """Encode a record: a buffer, or a sequence of integers."""
+        if not is_buffer(object):
+            object = bytearray(object)
+        self._append(len(object), binascii.hexlify(object),
+                     buffer_sum(object))
+
+    def encode_buffer(self, data, address=None):
+        """Encode a whole buffer, as records of record_size bytes.
+
+           Records are numbered from address, which must be a multiple
+           of record_size, or from after the last one encoded. Data
+           past 0xFFFF can't be addressed, and raises ValueError. The
+           buffer is converted to hex in one go, and each record is
+           sliced from that."""
+        if address is None:
+            address = self.record * self.record_size
+        if address % self.record_size:
+            raise ValueError("Can't start a record at %x" % address)
+        if address + len(data) > ADDRESS_LIMIT:
+            raise ValueError("Can't address %x" % (address + len(data) - 1))
+        self.record = address // self.record_size
+        (hex, data, cksums) = (binascii.hexlify(data), bytearray(data), [])
+        for off in xrange(0, len(data), self.record_size):
+            rs = min(self.record_size, len(data) - off)
+            addr = self.record * self.record_size
+            # The same as Checksum([rs, addr]).update(record)
+            cksum = rs + addr + buffer_sum(data[off:off + rs])
+            cksums.append(cksum)
+            self.record += 1
+            self.lines.append(";%02x%04x%s%04x" % (
+                rs, addr, hex[off * 2:(off + rs) * 2], cksum))
+        self.rolling_sum.update(cksums)
 
     def finalize(self):
-        self.lines.append(';00%04x%04x' % (self.record, self.rolling_sum))
+        self.lines.append(';00%04x%04x' % (self.record,
+                                           self.rolling_sum.value))
         return self.eol.join(self.lines)
 
 
 class MOSDecoder():
 
-    record = 0
-    sum = 0
-    buf = array.array("B")
+    """Decodes MOS Technology records.
 
-    def decode(self, object):
-        if object[0] != ';':
+       As with MOSEncoder, all state is per-instance."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything decoded, to start a new file."""
+        self.record = 0
+        self.sum = Checksum()
+        self.buf = array.array("B")
+
+    def _parse(self, line):
+        """Return the (address, payload) of a record.
+
+           Returns None for the last record."""
+        if line[:1] != ';':
             raise ValueError("Invalid input")
 
-        rlen = int(object[1:3], 16)
+        rlen = int(line[1:3], 16)
 
         if rlen == 0:
             # Validate, end of input
             # FIXME
-            return
-
-        (_addr, _bytes, _ck) = (object[3:7],
-                                object[7:7+rlen*2],
-                                object[7+rlen*2:7+rlen*2+4])
-
-        addr = int(_addr, 16)
-        cksum = int(_ck, 16)
-
-        r = range(0, len(_bytes) + 2, 2)
-        bytes = [int(_bytes[s:e], 16) for (s, e) in zip(r, r[1:])]
-        rsum = checksum([rlen, addr] + bytes)
-        if rsum != cksum:
+            return None
+
+        addr = int(line[3:7], 16)
+        try:
+            payload = bytearray(binascii.unhexlify(line[7:7 + rlen * 2]))
+        except TypeError:
+            raise ValueError("Invalid data on line %d" % self.record)
+        if len(payload) != rlen:
+            raise ValueError("Short record on line %d" % self.record)
+        # MOSEncoder doesn't truncate checksums to 16 bits, but other
+        # tools may, so only the low 16 bits are compared.
+        cksum = int(line[7 + rlen * 2:], 16)
+
+        # The same as Checksum([rlen, addr]).update(payload)
+        rsum = rlen + addr % 2**16 + buffer_sum(payload)
+        if rsum & 0xFFFF != cksum & 0xFFFF:
             raise ValueError(
                 "Checksum mismatch on line %d. Expected %04x, got %04x" %
                 (self.record, cksum, rsum))
         self.record += 1
-        self.sum = checksum([self.sum, rsum])
-        self.buf.extend(bytes)
+        self.sum.update([rsum])
+        return (addr, payload)
+
+    def decode(self, object):
+        """Decode a record, appending its payload to the buffer."""
+        record = self._parse(object)
+        if record:
+            self.buf.extend(record[1])
+
+    def gen_records(self, lines):
+        """Return a generator of (address, payload) for records in lines.
+
+           lines is an iterable of lines, like a file. It stops at the
+           last record."""
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = self._parse(line)
+            if record is None:
+                return
+            yield record
+
+    def decode_into(self, lines, out, offset=0):
+        """Decode records from lines, writing each at its address in out.
+
+           out is a file opened for writing, or a writable buffer
+           (bytearray, mmap or array('B')) large enough for every
+           record. Records are written at their address less offset as
+           they're decoded, so memory use doesn't grow with the input.
+           Returns the end address of the highest record."""
+        write = io.addressed_writer(out, offset)
+        end = 0
+        for (addr, payload) in self.gen_records(lines):
+            write(addr, payload)
+            end = max(end, addr + len(payload))
+        return end
 
     def finalize(self):
         return self.buf
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+"""Motorola S-record codecs"""
+
+import binascii
+
+from yar.cksum import buffer_sum
+import yar.io as io
+
+# Bytes of address in each record type
+ADDRESS_SIZES = {0: 2, 1: 2, 2: 3, 3: 4, 5: 2, 6: 3, 7: 4, 8: 3, 9: 2}
+
+# Data and termination record types, by address size
+DATA = {2: 1, 3: 2, 4: 3}
+TERMINATION = {2: 9, 3: 8, 4: 7}
+
+
+def address_sum(address):
+    """Return the sum of the bytes of address."""
+    return sum((address >> shift) & 0xFF for shift in (0, 8, 16, 24))
+
+
+def record(type, address, data=""):
+    """Return an S-record, without an EOL."""
+    size = ADDRESS_SIZES[type]
+    count = size + len(data) + 1
+    cksum = 0xFF - ((count + address_sum(address) + buffer_sum(data)) & 0xFF)
+    return "S%d%02X%0*X%s%02X" % (type, count, size * 2, address,
+                                  binascii.hexlify(data).upper(), cksum)
+
+
+class SRecordEncoder():
+
+    """Encodes bytes as Motorola S-records.
+
+       address_size is the bytes of address in each record: 2 for S1
+       records and an S9 termination record, 3 for S2 and S8, and 4
+       for S3 and S7. If header is set, it's sent in an S0 record.
+
+       All state is per-instance, as with MOSEncoder."""
+
+    def __init__(self, record_size=16, eol="\n", address_size=2,
+                 header=None):
+        if address_size not in DATA:
+            raise ValueError("Can't use %d-byte addresses" % address_size)
+        self.record_size = record_size
+        self.eol = eol
+        self.address_size = address_size
+        self.header = header
+        self.reset()
+
+    def reset(self):
+        """Forget everything encoded, to start a new file."""
+        self.address = 0
+        self.records = 0        # Data records encoded
+        self.lines = []
+        if self.header is not None:
+            self.lines.append(record(0, 0, self.header))
+
+    def encode_buffer(self, data, address=None):
+        """Encode a buffer at address, or after the last one encoded.
+
+           The buffer is converted to hex in one go, and each record
+           is sliced from that."""
+        if address is not None:
+            self.address = address
+        if self.address + len(data) > 1 << (self.address_size * 8):
+            raise ValueError("Can't address %x with %d bytes" % (
+                self.address + len(data) - 1, self.address_size))
+
+        (hex, data) = (binascii.hexlify(data).upper(), bytearray(data))
+        (type, width) = (DATA[self.address_size], self.address_size * 2)
+        for off in xrange(0, len(data), self.record_size):
+            rs = min(self.record_size, len(data) - off)
+            count = self.address_size + rs + 1
+            cksum = 0xFF - ((count + address_sum(self.address) +
+                             buffer_sum(data[off:off + rs])) & 0xFF)
+            self.lines.append("S%d%02X%0*X%s%02X" % (
+                type, count, width, self.address,
+                hex[off * 2:(off + rs) * 2], cksum))
+            self.address += rs
+            self.records += 1
+
+    def flush(self):
+        """Return the records encoded since the last flush.
+
+           Large images can be encoded a piece at a time, flushing
+           the records of each piece to a file."""
+        out = "".join(line + self.eol for line in self.lines)
+        self.lines = []
+        return out
+
+    def finalize(self, start=0):
+        """Return the remaining records, and the count and termination.
+
+           start is the address of the entry point."""
+        if self.records <= 0xFFFF:
+            self.lines.append(record(5, self.records))
+        elif self.records <= 0xFFFFFF:
+            self.lines.append(record(6, self.records))
+        self.lines.append(record(TERMINATION[self.address_size], start))
+        return self.flush()
+
+
+class SRecordDecoder():
+
+    """Decodes Motorola S-records.
+
+       Each record's checksum is verified, as is the record count, if
+       there's an S5 or S6 record. The header from an S0 record is kept
+       in header, and the entry point from the termination record in
+       start. As with MOSDecoder, all state is per-instance."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything decoded, to start a new file."""
+        self.record = 0
+        self.records = 0        # Data records decoded
+        self.header = None
+        self.start = None
+        self.done = False
+
+    def decode(self, line):
+        """Decode a record, returning its (address, payload).
+
+           Returns None for records other than data records."""
+        if line[:1] not in ("S", "s") or not line[1:2].isdigit():
+            raise ValueError("Invalid input on line %d" % self.record)
+        type = int(line[1])
+        if type not in ADDRESS_SIZES:
+            raise ValueError("Invalid record type S%d on line %d" % (
+                type, self.record))
+        try:
+            rec = bytearray(binascii.unhexlify(line[2:]))
+        except TypeError:
+            raise ValueError("Invalid data on line %d" % self.record)
+        size = ADDRESS_SIZES[type]
+        if len(rec) < size + 2 or len(rec) != rec[0] + 1:
+            raise ValueError("Bad record length on line %d" % self.record)
+        if buffer_sum(rec) & 0xFF != 0xFF:
+            raise ValueError("Checksum mismatch on line %d" % self.record)
+        self.record += 1
+
+        address = int(binascii.hexlify(rec[1:1 + size]), 16)
+        if type in (1, 2, 3):
+            self.records += 1
+            return (address, rec[1 + size:-1])
+
+        if type == 0:
+            self.header = str(rec[1 + size:-1])
+        elif type in (5, 6):
+            if address != self.records:
+                raise ValueError("Expected %d records, got %d" % (
+                    address, self.records))
+        else:
+            self.start = address
+            self.done = True
+        return None
+
+    def gen_records(self, lines):
+        """Return a generator of (address, payload) for data records.
+
+           lines is an iterable of lines, like a file. It stops at the
+           termination record."""
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            record = self.decode(line)
+            if self.done:
+                return
+            if record:
+                yield record
+
+    def decode_into(self, lines, out, offset=0):
+        """Decode records from lines, writing each at its address in out.
+
+           Records are written at their address less offset, with
+           io.addressed_writer(). Returns the end address of the
+           highest record."""
+        write = io.addressed_writer(out, offset)
+        end = 0
+        for (addr, payload) in self.gen_records(lines):
+            write(addr, payload)
+            end = max(end, addr + len(payload))
+        return end
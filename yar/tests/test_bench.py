@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+import json
+import os
+import tempfile
+import unittest
+
+import yar.bench as bench
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run(sorted(bench.SUITES), sizes=(2048,), min_time=0)
+        self.assertEqual(
+            sorted(r["path"] for r in results),
+            sorted(name for suite in bench.SUITES.values()
+                   for (name, _) in suite))
+        self.assertTrue(all(r["mb_s"] > 0 for r in results))
+
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            bench.save(results, path)
+            with open(path) as fd:
+                self.assertEqual(len(json.load(fd)["results"]), len(results))
+        finally:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from yar.cache import Cache, is_current
+import yar.io as io
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bin = os.path.join(self.dir, "rom.bin")
+        with open(self.bin, "wb") as fd:
+            fd.write("\x01\x02\x03")
+        self.zip = os.path.join(self.dir, "roms.zip")
+        with zipfile.ZipFile(self.zip, "w") as zfd:
+            zfd.writestr("a.bin", "\x04\x05")
+        self.cache = Cache(os.path.join(self.dir, "cache", "digests.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def test_lookup(self):
+        (entry, member) = io.gen_entries([self.bin, self.zip])
+        self.assertEqual(self.cache.lookup(entry, ("sum",)), None)
+        self.cache.store(entry, {"sum": "000006"})
+        self.cache.store(member, {"sum": "000009"})
+        self.assertEqual(self.cache.lookup(entry, ("sum",)),
+                         {"sum": "000006"})
+        self.assertEqual(self.cache.lookup(member, ("sum",)),
+                         {"sum": "000009"})
+        self.assertEqual(self.cache.lookup(entry, ("sum", "crc32")), None)
+
+    def test_prune(self):
+        (entry, member) = io.gen_entries([self.bin, self.zip])
+        self.cache.store(entry, {"sum": "000006"})
+        self.cache.store(member, {"sum": "000009"})
+        self.assertEqual(self.cache.prune(), 0)
+
+        os.utime(self.bin, (0, 0))
+        os.unlink(self.zip)
+        self.assertEqual(self.cache.prune(), 2)
+        self.assertEqual(self.cache.stats()["digests"], 0)
+
+    def test_is_current(self):
+        keys = set([("m1.0", 10), ("c0000abcd", 3)])
+        self.assertTrue(is_current("m1.0", 10, keys))
+        self.assertTrue(is_current("c0000abcd", 3, keys))
+        self.assertTrue(is_current("m1.0:a.bin", 3, keys))
+        self.assertFalse(is_current("m2.0", 10, keys))
+        self.assertFalse(is_current("m2.0:a.bin", 3, keys))
+        self.assertFalse(is_current("c0000abcd", 4, keys))
+
+
+if __name__ == '__main__':
+    unittest.main()
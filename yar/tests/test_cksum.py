@@ -4,9 +4,17 @@
 # Author: Ian Eure <ian.eure@gmail.com>
 #
 
+from array import array
+import hashlib
+import mmap
+import os
+import tempfile
 import unittest
+import zlib
 
-from yar.cksum import checksum
+from yar.cksum import checksum, Checksum, SplitChecksum, CRC32, MultiDigest, \
+    PrefixSums
+import yar.cksum as cksum
 
 class ChecksumTest(unittest.TestCase):
 
@@ -16,5 +24,152 @@ class ChecksumTest(unittest.TestCase):
         self.assertEqual(checksum([0xfffa, 0x4000]), 0x013ffa)
 
 
+class BufferChecksumTest(unittest.TestCase):
+
+    data = os.urandom(3 * cksum.CHUNK_SIZE + 17)
+
+    def expected(self):
+        return reduce(lambda a, b: a + b % 2**16, map(ord, self.data))
+
+    def test_buffers(self):
+        exp = self.expected()
+        self.assertEqual(checksum(self.data), exp)
+        self.assertEqual(checksum(bytearray(self.data)), exp)
+        self.assertEqual(checksum(array("B", self.data)), exp)
+        self.assertEqual(checksum(memoryview(self.data)), exp)
+        self.assertEqual(checksum(buffer(self.data)), exp)
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self.data)
+            fd.flush()
+            m = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.assertEqual(checksum(m), self.expected())
+            finally:
+                m.close()
+
+    def test_empty(self):
+        self.assertEqual(checksum(""), 0)
+        self.assertEqual(checksum(array("B")), 0)
+
+    def test_stdlib_fallback(self):
+        (numpy, cksum.numpy) = (cksum.numpy, None)
+        try:
+            self.assertEqual(checksum(self.data), self.expected())
+        finally:
+            cksum.numpy = numpy
+
+
+class IncrementalChecksumTest(unittest.TestCase):
+
+    def test_chunks(self):
+        data = os.urandom(1000)
+        c = Checksum()
+        for off in range(0, len(data), 64):
+            c.update(data[off:off + 64])
+        self.assertEqual(c.value, checksum(data))
+
+    def test_ints(self):
+        c = Checksum([0xfffa])
+        c.update([0x4000])
+        self.assertEqual(c.value, checksum([0xfffa, 0x4000]))
+        c.update([])
+        self.assertEqual(c.value, 0x013ffa)
+
+    def test_copy(self):
+        c = Checksum("\x01\x02")
+        d = c.copy()
+        d.update("\x03")
+        self.assertEqual(c.value, 3)
+        self.assertEqual(d.value, 6)
+
+    def test_digest(self):
+        c = Checksum([0xfffa, 0x4000])
+        self.assertEqual(c.programmer_sum(), 0x3ffa)
+        self.assertEqual(c.digest(), "\x3f\xfa")
+        self.assertEqual(c.hexdigest(), "3ffa")
+
+
+class SplitChecksumTest(unittest.TestCase):
+
+    data = os.urandom(2 * cksum.CHUNK_SIZE + 3)
+
+    def test_lanes(self):
+        sp = SplitChecksum(self.data)
+        bs = map(ord, self.data)
+        self.assertEqual(sp.total(), sum(bs))
+        self.assertEqual(sp.lanes(1), [sum(bs)])
+        self.assertEqual(sp.lanes(2), [sum(bs[0::2]), sum(bs[1::2])])
+        self.assertEqual(sp.lanes(4), [sum(bs[n::4]) for n in range(4)])
+        self.assertRaises(ValueError, sp.lanes, 3)
+
+    def test_nibbles(self):
+        sp = SplitChecksum("\x12\x34\x56\x78\x9a")
+        self.assertEqual(sp.nibbles(), (0x1e, 0x19))
+
+    def test_unaligned_updates(self):
+        sp = SplitChecksum()
+        for off in range(0, len(self.data), 333):
+            sp.update(self.data[off:off + 333])
+        whole = SplitChecksum(self.data)
+        self.assertEqual(sp.lanes(4), whole.lanes(4))
+        self.assertEqual(sp.nibbles(), whole.nibbles())
+        self.assertEqual(sp.copy().lanes(2), whole.lanes(2))
+
+
+class MultiDigestTest(unittest.TestCase):
+
+    data = os.urandom(5000)
+
+    def test_crc32(self):
+        crc = CRC32()
+        crc.update(self.data[:1000])
+        crc.update(bytearray(self.data[1000:2000]))
+        crc.update(memoryview(self.data)[2000:])
+        self.assertEqual(crc.hexdigest(),
+                         "%08x" % (zlib.crc32(self.data) & 0xFFFFFFFF))
+
+    def test_digests(self):
+        md = MultiDigest(("sum", "crc32", "sha1", "split16"))
+        for off in range(0, len(self.data), 1024):
+            md.update(self.data[off:off + 1024])
+        digests = md.hexdigests()
+        lanes = SplitChecksum(self.data).lanes(2)
+        self.assertEqual(digests, {
+            "sum": "%06x" % checksum(self.data),
+            "crc32": CRC32(self.data).hexdigest(),
+            "sha1": hashlib.sha1(self.data).hexdigest(),
+            "split16": "%06x %06x" % tuple(lanes)})
+
+
+class PrefixSumsTest(unittest.TestCase):
+
+    data = os.urandom(5000)
+
+    def check(self, sums):
+        self.assertEqual(len(sums), len(self.data))
+        for (start, end) in ((0, 0), (0, 5000), (17, 2048), (4999, 5000)):
+            self.assertEqual(sums.range_sum(start, end),
+                             sum(map(ord, self.data[start:end])))
+        self.assertRaises(ValueError, sums.range_sum, 0, 5001)
+        self.assertRaises(ValueError, sums.range_sum, 10, 9)
+
+        banks = sums.banks(2048)
+        self.assertEqual([(start, end) for (start, end, _) in banks],
+                         [(0, 2048), (2048, 4096), (4096, 5000)])
+        self.assertEqual(sum(s for (_, _, s) in banks), checksum(self.data))
+
+    def test_prefix_sums(self):
+        self.check(PrefixSums(self.data))
+
+    def test_stdlib_fallback(self):
+        (numpy, cksum.numpy) = (cksum.numpy, None)
+        try:
+            self.check(PrefixSums(self.data))
+        finally:
+            cksum.numpy = numpy
+
+
 if __name__ == '__main__':
     unittest.main()
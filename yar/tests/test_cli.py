@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+from contextlib import closing
+from itertools import cycle, islice
+from optparse import Values
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+from yar.cli import (convert_cmd, diff_ram_cmd, digest_algos, gen_digests,
+                     load_image, main)
+from yar.cksum import PrefixSums
+from yar.intelhex import IntelHexEncoder, IntelHexDecoder
+import yar.io as io
+from yar.srec import SRecordEncoder
+
+
+class LoadImageTest(unittest.TestCase):
+
+    data = os.urandom(0x2000)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def image(self, name, encoder, address):
+        encoder.encode_buffer(self.data, address)
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as fd:
+            fd.write(encoder.finalize())
+        return path
+
+    def test_intel_hex_base(self):
+        with load_image(self.image("rom.hex", IntelHexEncoder(),
+                                   0xE000)) as inp:
+            self.assertEqual(inp.read(), self.data)
+
+    def test_s1_base(self):
+        with load_image(self.image("rom.s19", SRecordEncoder(),
+                                   0x8000)) as inp:
+            self.assertEqual(inp.read(), self.data)
+
+    def test_convert(self):
+        hex = self.image("rom.hex", IntelHexEncoder(), 0xE000)
+        bin = os.path.join(self.dir, "rom.bin")
+        self.assertEqual(convert_cmd(None, hex, bin), 0)
+        self.assertEqual(os.path.getsize(bin), len(self.data))
+
+        # Converting back keeps the base address
+        out = os.path.join(self.dir, "out.hex")
+        self.assertEqual(convert_cmd(None, hex, out), 0)
+        with open(out, "rb") as fd:
+            self.assertEqual(
+                min(addr for (addr, _) in IntelHexDecoder().gen_records(fd)),
+                0xE000)
+
+    def test_binary(self):
+        path = os.path.join(self.dir, "rom.bin")
+        with open(path, "wb") as fd:
+            fd.write(self.data)
+        with load_image(path) as inp:
+            self.assertEqual(inp.read(), self.data)
+
+
+class GenDigestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.entries = []
+        for n in xrange(20):
+            path = os.path.join(self.dir, "%02d.bin" % n)
+            with open(path, "wb") as fd:
+                fd.write(os.urandom(n * 100))
+            self.entries.append(io.FileEntry(path))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_jobs(self):
+        serial = list(gen_digests(self.entries, ("sum", "sha1")))
+        self.assertEqual(list(gen_digests(self.entries, ("sum", "sha1"),
+                                          jobs=3)),
+                         serial)
+
+    def test_tar(self):
+        path = os.path.join(self.dir, "roms.tar.gz")
+        with closing(tarfile.open(path, "w:gz")) as tfd:
+            for entry in self.entries:
+                tfd.add(entry.path, os.path.basename(entry.path))
+
+        def open_tar(archive):
+            raise AssertionError("Opened %s for random access" % archive)
+
+        # Workers are forked with this in place
+        (orig, io.open_tar) = (io.open_tar, open_tar)
+        try:
+            self.assertEqual(
+                [digests for (_, digests) in
+                 gen_digests(io.gen_entries([path]), ("sha1",), jobs=3)],
+                [digests for (_, digests) in
+                 gen_digests(self.entries, ("sha1",))])
+        finally:
+            io.open_tar = orig
+
+    def test_streams(self):
+        digests = gen_digests(cycle(self.entries), ("sha1",), jobs=2)
+        try:
+            self.assertEqual(len(list(islice(digests, 50))), 50)
+        finally:
+            digests.close()
+
+
+class DigestAlgosTest(unittest.TestCase):
+
+    def test_digest_algos(self):
+        self.assertEqual(
+            digest_algos(Values({"digest": "sum, sha1", "split": None})),
+            ["sum", "sha1"])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, digest_algos,
+                          Values({"digest": "sum,bogus", "split": None}))
+
+
+class FakeYar():
+
+    """A programmer with ram in its RAM, which records its settings."""
+
+    def __init__(self, ram):
+        self.ram = ram
+        self.calls = []
+
+    def get_device(self):
+        return (0x12, 0x34)
+
+    def set_device(self, family, pinout):
+        self.calls.append(("set_device", family, pinout))
+
+    def set_ram_address(self, address):
+        self.calls.append(("set_ram_address", address))
+        return True
+
+    def checksum_range(self, start, size):
+        self.calls.append(("checksum_range", start, size))
+        return PrefixSums(self.ram).range_sum(start, start + size)
+
+    def read_range(self, start, size):
+        self.calls.append(("read_range", start, size))
+        return bytearray(self.ram[start:start + size])
+
+
+class DiffRamTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.write(fd, "\x00" * 1024)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_restores(self):
+        ram = bytearray(2048)
+        ram[700] = 1
+        yar = FakeYar(ram)
+        self.assertEqual(diff_ram_cmd(Values({"yar": lambda: yar}),
+                                      self.path), 1)
+        self.assertIn(("read_range", 512, 256), yar.calls)
+        self.assertEqual(yar.calls[-2:], [("set_ram_address", 0),
+                                          ("set_device", 0x12, 0x34)])
+
+
+class MainTest(unittest.TestCase):
+
+    def test_banks(self):
+        (argv, stderr) = (sys.argv, sys.stderr)
+        try:
+            sys.stderr = open(os.devnull, "w")
+            for banks in ("0", "-4"):
+                sys.argv = ["yar", "--banks", banks, "checksum", __file__]
+                self.assertRaises(SystemExit, main)
+        finally:
+            sys.stderr.close()
+            (sys.argv, sys.stderr) = (argv, stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,9 +4,13 @@
 # Author: Ian Eure <ian.eure@gmail.com>
 #
 
+from cStringIO import StringIO
+import os
+import types
 import unittest
 
-from yar.control import decode_errors, ProgrammerError
+from yar.cksum import Checksum, PrefixSums, checksum
+from yar.control import decode_errors, ProgrammerError, differing_blocks, Yar
 
 class ErrorDecodeTest(unittest.TestCase):
 
@@ -23,5 +27,131 @@ class ErrorClassTest(unittest.TestCase):
         self.assertEqual(x.message, 'Error: Programming error Start line not set high Device not blank RAM error RAM end not on 1K boundary')
 
 
+class DifferingBlocksTest(unittest.TestCase):
+
+    local = bytearray(os.urandom(8192))
+
+    def blocks(self, remote, min_block=256):
+        self.queries = 0
+
+        def remote_sum(start, end):
+            self.queries += 1
+            return checksum(remote[start:end]) & 0xFFFF
+
+        return differing_blocks(PrefixSums(self.local), remote_sum,
+                                0, len(self.local), min_block)
+
+    def test_same(self):
+        self.assertEqual(self.blocks(bytearray(self.local)), [])
+        self.assertEqual(self.queries, 1)
+
+    def test_differences(self):
+        remote = bytearray(self.local)
+        remote[100] ^= 0xFF
+        remote[5000] = (remote[5000] + 1) % 256
+        self.assertEqual(self.blocks(remote), [(0, 256), (4864, 5120)])
+        self.assertTrue(self.queries < 20)
+
+    def test_empty(self):
+        self.local = bytearray()
+        self.assertEqual(self.blocks(bytearray()), [])
+
+    def test_zero_sum(self):
+        (local, remote) = (bytearray(1024), bytearray(1024))
+        remote[700] = 1
+        yar = types.InstanceType(Yar)
+        yar.port = RAMPort(remote)
+        self.assertEqual(yar.checksum_range(0, 512), 0)
+        self.assertEqual(differing_blocks(
+            PrefixSums(local[:512]),
+            lambda start, end: yar.checksum_range(start, end - start),
+            0, 512), [])
+        self.assertEqual(
+            differing_blocks(PrefixSums(local),
+                             lambda start, end: yar.checksum_range(
+                                 start, end - start), 0, len(local)),
+            [(512, 768)])
+
+
+class FakePort():
+
+    """A serial port which reads from a string.
+
+       It never has a response waiting, so commands are ignored."""
+
+    def __init__(self, inp):
+        self.inp = inp
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+        return len(data)
+
+    def read(self, size):
+        (data, self.inp) = (self.inp[:size], self.inp[size:])
+        return data
+
+    def inWaiting(self):
+        return 0
+
+    def flush(self):
+        pass
+
+
+class RAMPort(FakePort):
+
+    """A serial port to a programmer which answers range checksums."""
+
+    def __init__(self, ram):
+        FakePort.__init__(self, "")
+        self.ram = ram
+        (self.start, self.size) = (0, len(ram))
+
+    def write(self, data):
+        (cmd, arg) = (data.strip()[-1:], data.strip()[:-1])
+        if cmd == "<":
+            self.start = int(arg, 16)
+        elif cmd == ";":
+            self.size = int(arg, 16)
+        if cmd == "S":
+            self.inp += "%04x>\r" % (checksum(
+                self.ram[self.start:self.start + self.size]) & 0xFFFF)
+        else:
+            self.inp += ">\r"
+        return FakePort.write(self, data)
+
+    def inWaiting(self):
+        return len(self.inp)
+
+
+def fake_yar(inp):
+    yar = types.InstanceType(Yar)
+    yar.port = FakePort(inp)
+    return yar
+
+
+class ReceiveTest(unittest.TestCase):
+
+    data = os.urandom(0x300)
+
+    def dump(self):
+        sum = Checksum(self.data).programmer_sum()
+        return ("\x0d\x08\x1c\x3e\x6b\x08\x00\x00\x00\x00" +
+                "".join(chr(int(n, 16)) for n in "%05x" % len(self.data)) +
+                "\x00" + self.data + "\x00\x00" + chr(sum >> 8) +
+                chr(sum & 0xFF))
+
+    def test_listeners(self):
+        (events, out) = ([], StringIO())
+        yar = fake_yar(self.dump())
+        self.assertEqual(yar._receive(out, [events.append]).tostring(),
+                         self.data)
+        self.assertEqual([e.done for e in events],
+                         range(128, len(self.data) + 1, 128))
+        self.assertTrue(all(e.phase == "dump" and e.total == len(self.data)
+                            for e in events))
+        self.assertEqual(out.getvalue(), str(events[-1]) + "\n")
+
+
 if __name__ == '__main__':
     unittest.main()
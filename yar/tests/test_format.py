@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+from cStringIO import StringIO
+import os
+import unittest
+
+import yar.format as format
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_by_path(self):
+        self.assertEqual(format.by_path("rom.HEX"), format.INTEL_HEX)
+        self.assertEqual(format.by_path("/a.b/rom.s19"),
+                         format.MOTOROLA_EXORCISER)
+        self.assertEqual(format.by_path("rom.bin"), format.BINARY)
+        self.assertEqual(format.by_path("rom"), format.BINARY)
+
+    def test_codecs(self):
+        data = os.urandom(1000)
+        for (code, (encoder, decoder)) in format.CODECS.iteritems():
+            e = encoder()
+            e.encode_buffer(data)
+            out = bytearray(len(data))
+            decoder().decode_into(StringIO(e.finalize()), out)
+            self.assertEqual(str(out), data, "Format %02x" % code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+import shutil
+import tempfile
+import unittest
+import os
+
+from yar.cksum import MultiDigest
+from yar.index import Index, DIGESTS
+
+
+def digests(data):
+    return MultiDigest(DIGESTS, data).hexdigests()
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = Index(os.path.join(self.dir, "index.sqlite"))
+        self.index.add("a.bin", 3, digests("\x01\x02\x03"))
+        self.index.add("b.zip:b.bin", 3, digests("\x01\x02\x03"))
+        self.index.add("c.bin", 2, digests("\x03\x03"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def test_sha1(self):
+        self.assertEqual(self.index.identify(3, digests("\x01\x02\x03")),
+                         [("a.bin", "sha1"), ("b.zip:b.bin", "sha1")])
+
+    def test_sum(self):
+        self.assertEqual(self.index.identify(2, digests("\x02\x04")),
+                         [("c.bin", "sum")])
+
+    def test_unknown(self):
+        self.assertEqual(self.index.identify(2, digests("\x01\x01")), [])
+        self.assertEqual(len(self.index), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+from cStringIO import StringIO
+import os
+import tempfile
+import unittest
+
+from yar.intelhex import IntelHexEncoder, IntelHexDecoder
+
+
+class IntelHexEncoderTest(unittest.TestCase):
+
+    def test_record(self):
+        e = IntelHexEncoder()
+        e.encode_buffer("214601360121470136007EFE09D21901".decode("hex"),
+                        0x100)
+        self.assertEqual(e.finalize(),
+                         ":10010000214601360121470136007EFE09D2190140\n"
+                         ":00000001FF\n")
+
+    def test_extended_linear(self):
+        e = IntelHexEncoder(record_size=32)
+        e.encode_buffer("\x01" * 0x30, 0xFFF0)
+        self.assertEqual(e.finalize().split("\n"), [
+            ":10FFF000" + "01" * 16 + "F1",
+            ":020000040001F9",
+            ":20000000" + "01" * 32 + "C0",
+            ":00000001FF", ""])
+
+    def test_extended_segment(self):
+        e = IntelHexEncoder(segmented=True)
+        e.encode_buffer("\x00", 0x12345)
+        self.assertEqual(e.finalize().split("\n")[0], ":020000021000EC")
+        self.assertRaises(ValueError, e.encode_buffer, "\x00", 0x100000)
+
+    def test_flush(self):
+        e = IntelHexEncoder()
+        e.encode_buffer("\x00" * 32)
+        self.assertEqual(len(e.flush().split("\n")), 3)
+        e.encode_buffer("\x00" * 16)
+        self.assertEqual(e.finalize(),
+                         ":10002000" + "00" * 16 + "D0\n:00000001FF\n")
+
+
+class IntelHexDecoderTest(unittest.TestCase):
+
+    data = os.urandom(0x18000)
+
+    def encoded(self, **kwargs):
+        e = IntelHexEncoder(**kwargs)
+        e.encode_buffer(self.data)
+        return e.finalize()
+
+    def test_round_trip(self):
+        for segmented in (False, True):
+            out = bytearray(len(self.data))
+            d = IntelHexDecoder()
+            self.assertEqual(
+                d.decode_into(StringIO(self.encoded(segmented=segmented)),
+                              out),
+                len(self.data))
+            self.assertEqual(str(out), self.data)
+            self.assertTrue(d.done)
+
+    def test_file(self):
+        lines = self.encoded().replace("\n", "\r\n").split("\n")
+        with tempfile.TemporaryFile() as fd:
+            IntelHexDecoder().decode_into(lines, fd)
+            fd.seek(0)
+            self.assertEqual(fd.read(), self.data)
+
+    def test_offset(self):
+        e = IntelHexEncoder()
+        e.encode_buffer("\x01\x02", 0x8000000)
+        out = bytearray(2)
+        IntelHexDecoder().decode_into(e.finalize().split(), out, 0x8000000)
+        self.assertEqual(out, bytearray("\x01\x02"))
+
+    def test_start(self):
+        d = IntelHexDecoder()
+        d.decode(":0400000500000CD11A")
+        self.assertEqual(d.start, 0xCD1)
+
+    def test_errors(self):
+        for line in (":10010000214601360121470136007EFE09D2190141",
+                     ":10010000214601360121470136007EFE09D21940",
+                     ":1001000021460136012147013600ZZFE09D2190140",
+                     "10010000214601360121470136007EFE09D2190140",
+                     ":00000007F9"):
+            self.assertRaises(ValueError, IntelHexDecoder().decode, line)
+
+
+if __name__ == '__main__':
+    unittest.main()
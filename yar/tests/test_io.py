@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+from contextlib import closing
+from cStringIO import StringIO
+import os
+import pickle
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from yar.cksum import Checksum
+import yar.io as io
+
+
+class EntryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bin = os.path.join(self.dir, "rom.bin")
+        with open(self.bin, "wb") as fd:
+            fd.write("\x01\x02\x03")
+        self.zip = os.path.join(self.dir, "roms.zip")
+        with zipfile.ZipFile(self.zip, "w") as zfd:
+            zfd.writestr("a.bin", "\x04\x05")
+            zfd.writestr("b.bin", "\x06")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_entries(self):
+        names = []
+        for entry in io.gen_entries([self.bin, self.zip]):
+            with entry.open() as fd:
+                names.append((entry.name, entry.size, fd.read()))
+        self.assertEqual(names, [(self.bin, 3, "\x01\x02\x03"),
+                                 (self.zip + ":a.bin", 2, "\x04\x05"),
+                                 (self.zip + ":b.bin", 1, "\x06")])
+
+    def test_pickled_entries(self):
+        entries = [pickle.loads(pickle.dumps(entry, 2))
+                   for entry in io.gen_entries([self.zip])]
+        self.assertEqual([entry.open().read() for entry in entries],
+                         ["\x04\x05", "\x06"])
+
+    def test_read(self):
+        self.assertEqual([entry.read()[:] for entry in
+                          io.gen_entries([self.bin, self.zip])],
+                         ["\x01\x02\x03", "\x04\x05", "\x06"])
+
+    def test_digest_entry(self):
+        (entry,) = io.gen_entries([self.bin])
+        self.assertEqual(io.digest_entry(entry, ("sum", "crc32")),
+                         {"sum": "000006", "crc32": "55bc801d"})
+
+
+class TarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for (name, data) in (("a.bin", "\x01\x02"), ("b.bin", "\x03")):
+            with open(os.path.join(self.dir, name), "wb") as fd:
+                fd.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def tar(self, mode):
+        path = os.path.join(self.dir, "roms.tar." + mode)
+        with closing(tarfile.open(path, "w:" + mode)) as tfd:
+            for name in ("a.bin", "b.bin"):
+                tfd.add(os.path.join(self.dir, name), name)
+        return path
+
+    def test_fds(self):
+        for mode in ("gz", "bz2"):
+            path = self.tar(mode)
+            self.assertEqual(
+                [(name, fd.read()) for fds in io.gen_fds([path])
+                 for (name, fd) in fds],
+                [(path + ":a.bin", "\x01\x02"), (path + ":b.bin", "\x03")])
+
+    def test_entries(self):
+        path = self.tar("gz")
+        entries = []
+        for entry in io.gen_entries([path]):
+            self.assertEqual(entry.read()[:], {"a.bin": "\x01\x02",
+                                               "b.bin": "\x03"}[entry.member])
+            entries.append(pickle.loads(pickle.dumps(entry, 2)))
+        self.assertEqual([entry.read()[:] for entry in reversed(entries)],
+                         ["\x03", "\x01\x02"])
+
+    def test_archive_type(self):
+        tar = self.tar("gz")
+        gz = os.path.join(self.dir, "rom.bin.gz")
+        os.rename(tar, gz)
+        with open(gz, "rb") as fd:
+            self.assertIsNone(io.archive_type(fd, gz))
+            self.assertEqual(io.archive_type(fd, tar), "tar")
+            self.assertEqual(fd.tell(), 0)
+
+        with open(self.tar(""), "rb") as fd:
+            self.assertEqual(io.archive_type(fd, "roms"), "tar")
+
+    def test_keep(self):
+        path = self.tar("bz2")
+
+        def open_tar(archive):
+            raise AssertionError("Opened %s for random access" % archive)
+
+        (orig, io.open_tar) = (io.open_tar, open_tar)
+        try:
+            entries = [pickle.loads(pickle.dumps(io.detach(e, keep=True), 2))
+                       for e in io.gen_entries([path])]
+            self.assertEqual([e.read()[:] for e in entries],
+                             ["\x01\x02", "\x03"])
+        finally:
+            io.open_tar = orig
+
+
+class NestedArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.inner = os.path.join(self.dir, "inner.zip")
+        with zipfile.ZipFile(self.inner, "w") as zfd:
+            zfd.writestr("a.bin", "\x01\x02")
+        self.tar = os.path.join(self.dir, "mid.tar.gz")
+        with closing(tarfile.open(self.tar, "w:gz")) as tfd:
+            tfd.add(self.inner, "inner.zip")
+        self.outer = os.path.join(self.dir, "outer.zip")
+        with zipfile.ZipFile(self.outer, "w") as zfd:
+            zfd.write(self.tar, "mid.tar.gz")
+            zfd.writestr("fake.zip", "\x03")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def names(self, depth):
+        return [entry.name[len(self.outer) + 1:]
+                for entry in io.gen_entries([self.outer], depth=depth)]
+
+    def test_depth(self):
+        self.assertEqual(self.names(0), ["mid.tar.gz", "fake.zip"])
+        self.assertEqual(self.names(1), ["mid.tar.gz:inner.zip", "fake.zip"])
+        self.assertEqual(self.names(2), ["mid.tar.gz:inner.zip:a.bin",
+                                         "fake.zip"])
+        self.assertEqual(
+            [name[len(self.outer) + 1:] for fds in
+             io.gen_fds([self.outer], depth=2) for (name, _) in fds],
+            self.names(2))
+
+    def test_read(self):
+        entries = list(io.gen_entries([self.outer], depth=2))
+        detached = [pickle.loads(pickle.dumps(entry, 2))
+                    for entry in entries]
+        self.assertEqual([entry.read()[:] for entry in detached],
+                         ["\x01\x02", "\x03"])
+        self.assertEqual(entries[0].key()[0], os.path.abspath(self.outer))
+
+    def test_nested_fake(self):
+        with zipfile.ZipFile(self.inner, "a") as zfd:
+            zfd.writestr("fake.zip", "\x04")
+        outer = os.path.join(self.dir, "outer2.zip")
+        with zipfile.ZipFile(outer, "w") as zfd:
+            zfd.write(self.inner, "inner.zip")
+        # Members which aren't archives after all are detached
+        entries = list(io.gen_entries([outer], depth=2))
+        self.assertEqual(entries[-1].name, outer + ":inner.zip:fake.zip")
+        self.assertEqual(entries[-1].read()[:], "\x04")
+
+
+class WalkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for path in ("b.bin", "a.zip", "sub/c.bin", "sub/deep/d.bin",
+                     "skip/e.bin", "a/f.bin"):
+            path = os.path.join(self.dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as fd:
+                fd.write("\x01" * len(path))
+        os.symlink("nowhere", os.path.join(self.dir, "broken.bin"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def walk(self, *args, **kwargs):
+        return [path[len(self.dir) + 1:] for (path, _) in
+                io.walk([self.dir], *args, **kwargs)]
+
+    def test_walk(self):
+        self.assertEqual(self.walk(), ["a.zip", "b.bin", "a/f.bin",
+                                       "skip/e.bin", "sub/c.bin",
+                                       "sub/deep/d.bin"])
+
+    def test_patterns(self):
+        self.assertEqual(self.walk(["*.bin"], ["skip", "d*"]),
+                         ["b.bin", "a/f.bin", "sub/c.bin"])
+
+    def test_stat(self):
+        for (path, st) in io.walk([self.dir]):
+            self.assertEqual(st.st_size, len(path))
+
+    def test_listdir(self):
+        (scandir, io.scandir) = (io.scandir, None)
+        try:
+            self.test_walk()
+            self.test_stat()
+        finally:
+            io.scandir = scandir
+
+    def test_unreadable(self):
+        def scan_dir(dir_):
+            if dir_.endswith("sub"):
+                raise OSError(13, "Permission denied", dir_)
+            return orig(dir_)
+
+        (orig, io.scan_dir) = (io.scan_dir, scan_dir)
+        try:
+            self.assertEqual(self.walk(), ["a.zip", "b.bin", "a/f.bin",
+                                           "skip/e.bin"])
+        finally:
+            io.scan_dir = orig
+
+    def test_entries(self):
+        path = os.path.join(self.dir, "b.bin")
+        entries = list(io.gen_entries(io.walk([path, self.dir], ["b*"])))
+        self.assertEqual([e.name for e in entries], [path, path])
+        self.assertEqual(entries[1].size, len(path))
+
+
+class SameSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for (name, data) in (("a", "abc"), ("b", "def"), ("c", "12345"),
+                             ("d", "1234"), ("e", ""), ("f", "")):
+            with open(os.path.join(self.dir, name), "wb") as fd:
+                fd.write(data)
+        with zipfile.ZipFile(os.path.join(self.dir, "g.zip"), "w") as zfd:
+            zfd.writestr("h", "54321")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_same_size(self):
+        entries = io.same_size(io.gen_entries(io.walk([self.dir])))
+        self.assertEqual([os.path.basename(e.name) for e in entries],
+                         ["a", "b", "c", "g.zip:h"])
+        self.assertEqual(str(entries[-1].read()), "54321")
+
+    def test_nested(self):
+        inner = os.path.join(self.dir, "inner.zip")
+        with zipfile.ZipFile(inner, "w") as zfd:
+            zfd.writestr("i", "xy")
+            zfd.writestr("j", "zw")
+        with zipfile.ZipFile(os.path.join(self.dir, "outer.zip"), "w") as zfd:
+            zfd.write(inner, "inner.zip")
+        os.unlink(inner)
+
+        entries = io.same_size(io.gen_entries(io.walk([self.dir]), depth=1))
+        self.assertEqual([str(e.read()) for e in entries
+                          if "inner.zip:" in e.name], ["xy", "zw"])
+
+    def test_tar(self):
+        path = os.path.join(self.dir, "roms.tar.gz")
+        with closing(tarfile.open(path, "w:gz")) as tfd:
+            for name in ("a", "d", "b"):
+                tfd.add(os.path.join(self.dir, name), name)
+
+        def open_tar(archive):
+            raise AssertionError("Opened %s for random access" % archive)
+
+        (orig, io.open_tar) = (io.open_tar, open_tar)
+        try:
+            entries = io.same_size(io.gen_entries([path]))
+            entries += [pickle.loads(pickle.dumps(e, 2)) for e in entries]
+            self.assertEqual([(e.member, str(e.read())) for e in entries],
+                             [("a", "abc"), ("b", "def")] * 2)
+        finally:
+            io.open_tar = orig
+
+
+class LoadBufferTest(unittest.TestCase):
+
+    data = os.urandom(10000)
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self.data)
+            fd.seek(100)
+            with io.load_buffer(fd) as buf:
+                self.assertEqual(len(buf), 9900)
+                self.assertEqual(buf[:], self.data[100:])
+                self.assertEqual(fd.tell(), 10000)
+            # The map is gone with the block
+            self.assertRaises(TypeError, lambda: buf[:])
+
+    def test_empty_file(self):
+        with tempfile.TemporaryFile() as fd, io.load_buffer(fd) as buf:
+            self.assertEqual(buf[:], "")
+
+    def test_pipe(self):
+        (r, w) = os.pipe()
+        os.write(w, self.data[:1000])
+        os.close(w)
+        with os.fdopen(r, "rb") as fd, io.load_buffer(fd) as buf:
+            self.assertEqual(buf[:], self.data[:1000])
+            self.assertEqual(fd.read(), "")
+
+    def test_sized(self):
+        dir_ = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir_, "roms.zip")
+            with zipfile.ZipFile(path, "w") as zfd:
+                zfd.writestr("a.bin", self.data)
+            with zipfile.ZipFile(path) as zfd:
+                for size in (len(self.data), 10, None):
+                    with zfd.open("a.bin") as fd, \
+                            io.load_buffer(fd, size) as buf:
+                        self.assertEqual(buf[:], self.data)
+        finally:
+            shutil.rmtree(dir_)
+
+
+class FileToBytesTest(unittest.TestCase):
+
+    data = os.urandom(10000)
+
+    def test_sized(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self.data)
+            fd.seek(0)
+            self.assertEqual(io.size_of(fd), 10000)
+            self.assertEqual(io.file_to_bytes(fd).tostring(), self.data)
+
+    def test_unsized(self):
+        (r, w) = os.pipe()
+        os.write(w, self.data)
+        os.close(w)
+        with os.fdopen(r, "rb") as fd:
+            self.assertEqual(io.size_of(fd), None)
+            self.assertEqual(io.file_to_bytes(fd, bs=4096).tostring(),
+                             self.data)
+
+
+class PipelineTest(unittest.TestCase):
+
+    data = os.urandom(10000)
+
+    def test_views(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self.data)
+            fd.seek(0)
+            self.assertEqual([len(v) for v in io.gen_views(fd, 4096)],
+                             [4096, 4096, 1808])
+
+    def test_pipeline(self):
+        (sum, out) = (Checksum(), StringIO())
+        chunks = io.pipeline(
+            io.gen_views(StringIO(self.data), 1000),
+            io.digest(sum),
+            io.transform(lambda chunk: chunk.tobytes().upper(),
+                         lambda: "END"),
+            io.sink(out))
+        self.assertEqual(io.drain(chunks), 10003)
+        self.assertEqual(sum.value, Checksum(self.data).value)
+        self.assertEqual(out.getvalue(), self.data.upper() + "END")
+
+
+class ReblockTest(unittest.TestCase):
+
+    def test_reblock(self):
+        blocks = list(io.pipeline(["abc", "defgh", "", "ij", "klmno"],
+                                  io.reblock(4)))
+        self.assertEqual(blocks, ["abcd", "efgh", "ijkl", "mno"])
+
+
+class FailingFile():
+
+    def __init__(self):
+        self.reads = 0
+
+    def read(self, size):
+        self.reads += 1
+        if self.reads > 2:
+            raise IOError("Disk on fire")
+        return "x" * size
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    data = os.urandom(10000)
+
+    def test_file(self):
+        with tempfile.TemporaryFile() as fd:
+            fd.write(self.data)
+            fd.seek(1000)
+            with io.Prefetcher(fd, bs=4096, depth=1) as source:
+                self.assertEqual(source.size, 9000)
+                chunks = list(source)
+                self.assertEqual(list(source), [])
+        self.assertEqual([len(chunk) for chunk in chunks], [4096, 4096, 808])
+        self.assertEqual("".join(chunks), self.data[1000:])
+
+    def test_unsized(self):
+        with io.Prefetcher(StringIO(self.data)) as source:
+            self.assertIsNone(source.size)
+            self.assertEqual("".join(source), self.data)
+
+    def test_error(self):
+        with io.Prefetcher(FailingFile(), bs=10) as source:
+            chunks = iter(source)
+            self.assertEqual(chunks.next(), "x" * 10)
+            self.assertEqual(chunks.next(), "x" * 10)
+            self.assertRaises(IOError, chunks.next)
+
+    def test_close(self):
+        source = io.Prefetcher(StringIO(self.data), bs=10, depth=2)
+        source.close()
+        self.assertFalse(source._thread.is_alive())
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.time, io.time) = (io.time, FakeClock())
+
+    def tearDown(self):
+        io.time = self.time
+
+    def test_unstarted(self):
+        p = io.Progress(1024)
+        self.assertIsNone(p.eta())
+        self.assertEqual(repr(p), "[0/1024] bytes, 00% @0b/s, eta --")
+
+    def test_smoothed_rate(self):
+        p = io.Progress(10000)
+        p.start()
+        for done in xrange(1000, 5001, 1000):
+            io.time.now += 1
+            p.update(done)
+        self.assertEqual(p.rate(), 1000)
+        self.assertEqual(p.eta(), (0, 5))
+
+        # A stall drags the smoothed rate down, but not all the way.
+        io.time.now += 1
+        p.update(5000)
+        self.assertTrue(500 < p.rate() < 1000)
+
+    def test_complete(self):
+        p = io.Progress(2048)
+        p.start()
+        io.time.now += 2
+        p.update(2048)
+        io.time.now += 60
+        self.assertEqual(repr(p), "2048 bytes in 0m02s @1024b/s")
+
+
+class ProgressListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.time, io.time) = (io.time, FakeClock())
+
+    def tearDown(self):
+        io.time = self.time
+
+    def test_events(self):
+        events = []
+        p = io.Progress(300, "load", [events.append])
+        p.start()
+        for done in (100, 300):
+            io.time.now += 1
+            p.update(done)
+
+        self.assertEqual([(e.phase, e.done, e.total, e.finished)
+                          for e in events],
+                         [("load", 0, 300, False), ("load", 100, 300, False),
+                          ("load", 300, 300, True)])
+        self.assertEqual(events[-1].rate, 200)
+        self.assertEqual(events[-1].average, 150)
+        self.assertEqual(events[-1].elapsed, 2)
+
+    def test_unknown_total(self):
+        events = []
+        p = io.Progress(None, "program", [events.append])
+        p.start()
+        io.time.now += 5
+        p.notify()
+        p.complete()
+        self.assertEqual(map(str, events),
+                         ["program: 0m00s elapsed", "program: 0m05s elapsed",
+                          "program: done in 0m05s"])
+
+
+class ProgressRendererTest(unittest.TestCase):
+
+    def test_render(self):
+        renderer = io.ProgressRenderer(StringIO(), fps=1000)
+        p = io.Progress(100, listeners=[renderer])
+        with renderer:
+            p.update(50)
+            p.update(100)
+        self.assertTrue(renderer.out.getvalue().endswith(repr(p) + "\n"))
+
+    def test_no_output(self):
+        with io.ProgressRenderer(None) as r:
+            io.Progress(100, listeners=[r]).update(100)
+            self.assertIsNone(r._thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
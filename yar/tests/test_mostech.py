@@ -4,10 +4,29 @@
 # Author: Ian Eure <ian.eure@gmail.com>
 #
 
+from array import array
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
 import unittest
 
 from yar.mostech import MOSEncoder, MOSDecoder
 
+
+def reference_encode(data, record_size=16):
+    """Encode data one byte at a time, as MOSEncoder used to."""
+    (lines, rolling) = ([], 0)
+    for (record, off) in enumerate(xrange(0, len(data), record_size)):
+        object = data[off:off + record_size]
+        (rs, addr) = (len(object), record * record_size)
+        cksum = reduce(lambda a, b: a + b % 2**16, [rs, addr] + object)
+        rolling += cksum % 2**16
+        lines.append(";%02x%04x%s%04x" % (
+            rs, addr, "".join(["%02x" % b for b in object]), cksum))
+    lines.append(";00%04x%04x" % (len(lines), rolling))
+    return "\n".join(lines)
+
 class MOSCodecTest(unittest.TestCase):
 
     bytes = [0xf3, 0xed, 0x56, 0xc3, 0xe6, 0x00, 0xfd, 0x00,
@@ -28,5 +47,122 @@ class MOSCodecTest(unittest.TestCase):
         self.assertEqual(d.finalize().tolist(), self.bytes)
 
 
+class MOSEncoderTest(unittest.TestCase):
+
+    data = [ord(b) for b in os.urandom(0x10000)]
+
+    def test_encode(self):
+        e = MOSEncoder()
+        for off in xrange(0, len(self.data), 16):
+            e.encode(self.data[off:off + 16])
+        self.assertEqual(e.finalize(), reference_encode(self.data))
+
+    def test_encode_buffer(self):
+        for (size, record_size) in ((0, 16), (1, 16), (40, 16), (0x10000, 32)):
+            e = MOSEncoder(record_size=record_size)
+            e.encode_buffer(bytearray(self.data[:size]))
+            self.assertEqual(e.finalize(),
+                             reference_encode(self.data[:size], record_size))
+
+    def test_address(self):
+        e = MOSEncoder()
+        e.encode_buffer("\x01\x02", 0xE000)
+        out = bytearray(2)
+        MOSDecoder().decode_into(e.finalize().split(), out, 0xE000)
+        self.assertEqual(out, bytearray("\x01\x02"))
+        self.assertRaises(ValueError, e.encode_buffer, "\x01", 0xE001)
+
+
+class MOSDecoderTest(unittest.TestCase):
+
+    data = os.urandom(4000)
+
+    def setUp(self):
+        e = MOSEncoder()
+        e.encode_buffer(self.data)
+        self.encoded = e.finalize()
+
+    def test_buffer(self):
+        out = bytearray(len(self.data))
+        self.assertEqual(MOSDecoder().decode_into(StringIO(self.encoded), out),
+                         len(self.data))
+        self.assertEqual(str(out), self.data)
+
+    def test_array(self):
+        out = array("B", [0xFF] * (len(self.data) + 1))
+        MOSDecoder().decode_into(self.encoded.split("\n"), out)
+        self.assertEqual(out.tostring(), self.data + "\xff")
+
+    def test_file(self):
+        with tempfile.TemporaryFile() as fd:
+            MOSDecoder().decode_into(StringIO(self.encoded), fd)
+            fd.seek(0)
+            self.assertEqual(fd.read(), self.data)
+
+    def test_too_small(self):
+        self.assertRaises(ValueError, MOSDecoder().decode_into,
+                          StringIO(self.encoded), bytearray(100))
+
+    def test_checksum_mismatch(self):
+        lines = self.encoded.split("\n")
+        lines[3] = lines[3][:9] + ("0" if lines[3][9] != "0" else "1") + \
+            lines[3][10:]
+        self.assertRaises(ValueError, MOSDecoder().decode_into, lines,
+                          bytearray(len(self.data)))
+
+    def test_64k(self):
+        data = os.urandom(0x10000)
+        e = MOSEncoder()
+        e.encode_buffer(data)
+        out = bytearray(len(data))
+        self.assertEqual(MOSDecoder().decode_into(e.finalize().split(), out),
+                         len(data))
+        self.assertEqual(str(out), data)
+
+        # Records past 64KiB can't be addressed
+        e = MOSEncoder()
+        self.assertRaises(ValueError, e.encode_buffer, data + "\x00")
+        e.encode_buffer(data)
+        self.assertRaises(ValueError, e.encode, [0])
+
+
+def round_trip(data):
+    e = MOSEncoder()
+    for off in xrange(0, len(data), 16):
+        e.encode(data[off:off + 16])
+    encoded = e.finalize()
+
+    d = MOSDecoder()
+    for line in encoded.split("\n"):
+        d.decode(line)
+    return (encoded, d.finalize().tostring())
+
+
+class MOSInstanceTest(unittest.TestCase):
+
+    def test_reset(self):
+        (e, d) = (MOSEncoder(), MOSDecoder())
+        for data in ("\x01\x02\x03", "\x04\x05"):
+            e.reset()
+            e.encode_buffer(data)
+            d.reset()
+            for line in e.finalize().split("\n"):
+                d.decode(line)
+            self.assertEqual(d.finalize().tostring(), data)
+            self.assertEqual(d.record, 1)
+
+    def test_threads(self):
+        inputs = [os.urandom(1000 + n) for n in xrange(32)]
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(round_trip, inputs)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([decoded for (_, decoded) in results], inputs)
+        self.assertEqual([encoded for (encoded, _) in results],
+                         [round_trip(data)[0] for data in inputs])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# © 2014 Ian Eure
+# Author: Ian Eure <ian.eure@gmail.com>
+#
+
+from cStringIO import StringIO
+import os
+import unittest
+
+from yar.srec import SRecordEncoder, SRecordDecoder
+
+
+class SRecordEncoderTest(unittest.TestCase):
+
+    def test_s1(self):
+        e = SRecordEncoder(header="HDR")
+        e.encode_buffer("0A0A0D00000000000000000000000000".decode("hex"),
+                        0x7AF0)
+        self.assertEqual(e.finalize().split("\n"), [
+            "S00600004844521B",
+            "S1137AF00A0A0D0000000000000000000000000061",
+            "S5030001FB",
+            "S9030000FC",
+            ""])
+
+    def test_address_sizes(self):
+        for (size, data, end) in ((3, "S2", "S804000000FB"),
+                                  (4, "S3", "S70500000000FA")):
+            e = SRecordEncoder(address_size=size)
+            e.encode_buffer("\x00")
+            lines = e.finalize().split()
+            self.assertEqual(lines[0][:2], data)
+            self.assertEqual(lines[-1], end)
+
+    def test_too_far(self):
+        e = SRecordEncoder()
+        self.assertRaises(ValueError, e.encode_buffer, "\x00\x00", 0xFFFF)
+        self.assertRaises(ValueError, SRecordEncoder, address_size=1)
+
+
+class SRecordDecoderTest(unittest.TestCase):
+
+    data = os.urandom(5000)
+
+    def test_round_trip(self):
+        for size in (2, 3, 4):
+            e = SRecordEncoder(address_size=size, header="test")
+            e.encode_buffer(self.data, 0x100)
+            (d, out) = (SRecordDecoder(), bytearray(len(self.data)))
+            self.assertEqual(
+                d.decode_into(StringIO(e.finalize(start=0x104)), out, 0x100),
+                0x100 + len(self.data))
+            self.assertEqual(str(out), self.data)
+            self.assertEqual((d.header, d.start, d.done),
+                             ("test", 0x104, True))
+
+    def test_count(self):
+        e = SRecordEncoder()
+        e.encode_buffer("\x00" * 32)
+        lines = e.finalize().split()
+        del lines[1]
+        self.assertRaises(ValueError, SRecordDecoder().decode_into,
+                          lines, bytearray(32))
+
+    def test_errors(self):
+        for line in ("S1137AF00A0A0D0000000000000000000000000062",
+                     "S1137AF00A0A0D00000000000000000000000061",
+                     "S4030000FC",
+                     "X9030000FC",
+                     "S9030000ZZ"):
+            self.assertRaises(ValueError, SRecordDecoder().decode, line)
+
+
+if __name__ == '__main__':
+    unittest.main()